@@ -0,0 +1,407 @@
+"""Measure how fast the engine is, and track it between versions.
+
+The benchmarks come in two kinds.  Microbenchmarks time one part of the
+engine over and over: working out the player's intent, running each kind of
+command through `Parser.parse_command`, checking preconditions, connecting
+locations, building the games with `build_game()`, and writing the map
+with `mapexport.py`.  Macrobenchmarks replay long transcripts of commands against the
+game's own small world and against a large world from worldgen.py, and time
+the whole transcript.
+
+Each benchmark is run several times, and the time per operation of every
+run is kept, so the results show the spread as well as the median.  They
+can be written as JSON, and compared against the JSON of an earlier run to
+find regressions:
+
+```
+python3 bench.py task1 --json before.json
+python3 bench.py task1 --compare before.json
+```
+
+Use `--filter` to run only the benchmarks whose names contain some text,
+and `--rooms` to change the size of the generated world.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from mapexport import MapExporter
+from replay import load_engine, read_transcript, replay
+import worldgen
+
+
+class Case:
+  """One benchmark, ready to run."""
+  def __init__(self, function, operations=1, timed_inside=False):
+    # The function to time.  It takes no arguments.
+    self.function = function
+    # How many operations one call of the function does.
+    self.operations = operations
+    # If True the function times the part that matters itself, and returns
+    # how many seconds it took.
+    self.timed_inside = timed_inside
+
+
+class Result:
+  """The timings of one benchmark."""
+  def __init__(self, name, group, operations):
+    self.name = name
+    # "micro" or "macro".
+    self.group = group
+    # How many operations each run did.
+    self.operations = operations
+    # The seconds per operation of each run.
+    self.samples = []
+
+  def median(self):
+    return statistics.median(self.samples)
+
+  def as_dict(self):
+    return {
+      "name": self.name,
+      "group": self.group,
+      "operations": self.operations,
+      "runs": len(self.samples),
+      "min": min(self.samples),
+      "median": self.median(),
+      "mean": statistics.mean(self.samples),
+      "stdev": statistics.stdev(self.samples) if len(self.samples) > 1 else 0.0,
+      "samples": self.samples,
+    }
+
+
+def run_case(name, group, case, runs=5, min_time=0.05):
+  """Time a case.  Unless the case times itself, the number of calls in each
+     run is picked so that a run takes at least min_time seconds, which
+     keeps the timer's resolution from mattering."""
+  timer = time.perf_counter
+  calls = 1
+  if not case.timed_inside:
+    case.function()
+    while True:
+      start = timer()
+      for _ in range(calls):
+        case.function()
+      if timer() - start >= min_time:
+        break
+      calls *= 2
+  result = Result(name, group, calls * case.operations)
+  for _ in range(runs):
+    if case.timed_inside:
+      elapsed = case.function()
+    else:
+      start = timer()
+      for _ in range(calls):
+        case.function()
+      elapsed = timer() - start
+    result.samples.append(elapsed / result.operations)
+  return result
+
+
+def build_quietly(engine):
+  """Build the engine's game without printing anything."""
+  game = engine.build_game()
+  game.output = engine.NullSink()
+  return game
+
+
+def wander(engine, game, steps, seed=0):
+  """Returns a transcript of a random walk through a game: moving, looking
+     around, examining things, and taking and dropping items.  Commands that
+     would end the game are left out, so the whole transcript can be
+     replayed.  The game is back where it started afterwards."""
+  parser = engine.Parser(game)
+  generator = random.Random(seed)
+  commands = []
+  with game.dry_run():
+    while len(commands) < steps:
+      location = game.curr_location
+      choices = list(location.connections) + ["look", "inventory"]
+      for item in location.items.values():
+        choices.append("examine " + item.name)
+        if item.gettable:
+          choices.append("take " + item.name)
+      for item in game.inventory.values():
+        choices.append("drop " + item.name)
+      command = generator.choice(choices)
+      if parser.simulate(command).end_game:
+        continue
+      parser.parse_command(command)
+      commands.append(command)
+  return commands
+
+
+# Microbenchmarks.  Each function sets up a benchmark for the engine module
+# and returns a Case.
+
+def build_garden(engine):
+  """Build a small world with the engine's objects, for the benchmarks of
+     the parser.  It has a garden with a rosebush, and a path to the north,
+     and the player has picked the rose."""
+  garden = engine.Location("Garden", "You are in a garden.")
+  path = engine.Location("Path", "You are on a path.")
+  garden.add_connection("north", path)
+  rosebush = engine.Item("rosebush", "a rosebush", "It has a single red rose.",
+                         start_at=garden, gettable=False)
+  rose = engine.Item("rose", "a red rose", "It smells good.")
+  rosebush.add_action("pick rose", engine.add_item_to_inventory,
+                      (rose, "You pick the rose.", "You already picked the rose."))
+  engine.Item("pole", "a fishing pole", "A simple fishing pole.", start_at=garden)
+  game = engine.Game(garden)
+  game.output = engine.NullSink()
+  # Keep the history short, so that it doesn't grow while timing.
+  game.history = engine.History(10)
+  engine.Parser(game).parse_command("pick rose")
+  return game
+
+def bench_player_intent(engine, options):
+  parser = engine.Parser(build_garden(engine))
+  commands = ["north", "go out", "look", "take the pole", "drop it", "examine rosebush",
+              "inventory", "pick rose", "smell the rose", "sing a song", "n, s"]
+  def run():
+    for command in commands:
+      parser.get_player_intent(command)
+  return Case(run, len(commands))
+
+# The commands that benchmark each intent of parse_command.  Each list
+# leaves the world from build_garden() as it found it.
+INTENT_COMMANDS = {
+  "direction": ["north", "south"],
+  "redescribe": ["look"],
+  "examine": ["examine rosebush"],
+  "take_drop": ["take rose", "drop rose"],
+  "inventory": ["inventory"],
+  "special": ["pick rose"],
+  "sequence": ["look, inventory"],
+  "undo_redo": ["undo", "redo"],
+  "unknown": ["sing a song"],
+}
+
+def bench_parse_command(intent):
+  def setup(engine, options):
+    parser = engine.Parser(build_garden(engine))
+    commands = INTENT_COMMANDS[intent]
+    def run():
+      for command in commands:
+        parser.parse_command(command)
+    return Case(run, len(commands))
+  return setup
+
+def bench_check_preconditions(engine, options):
+  room = engine.Location("Room", "A room.")
+  key = engine.Item("key", "a key")
+  lamp = engine.Item("lamp", "a lamp", start_at=room)
+  game = engine.Game(room)
+  game.output = engine.NullSink()
+  game.add_to_inventory(key)
+  met = engine.compile_preconditions({"inventory_contains": key, "in_location": room,
+                                      "location_has_item": lamp})
+  unmet = engine.compile_preconditions({"inventory_contains": lamp, "in_location": room})
+  def run():
+    engine.check_preconditions(met, game)
+    engine.check_preconditions(unmet, game, print_failure_reasons=False)
+  return Case(run, 2)
+
+def bench_is_blocked(engine, options):
+  game = build_quietly(engine)
+  location = game.curr_location
+  direction = next(iter(location.connections))
+  location.add_block(direction, "Blocked.", {"inventory_contains": engine.Item("key", "a key")})
+  game.index_world()
+  def run():
+    location.is_blocked(direction, game, print_failure_reasons=False)
+  return Case(run)
+
+def bench_add_connection(engine, options):
+  locations = [engine.Location("Room %d" % number, "A room.") for number in range(1000)]
+  pairs = list(zip(locations, locations[1:]))
+  def run():
+    for location, next_location in pairs:
+      location.add_connection("north", next_location)
+  return Case(run, len(pairs))
+
+def bench_add_connections(engine, options):
+  locations = [engine.Location("Room %d" % number, "A room.") for number in range(1000)]
+  connections = [(location, "north", next_location)
+                 for location, next_location in zip(locations, locations[1:])]
+  def run():
+    engine.add_connections(connections)
+  return Case(run, len(connections))
+
+def bench_build_game(name):
+  def setup(engine, options):
+    game_engine = load_engine(name)
+    return Case(game_engine.build_game)
+  return setup
+
+def bench_map(engine, options):
+  game = build_quietly(engine)
+  return Case(lambda: MapExporter(game).export(io.StringIO(), "dot"))
+
+def bench_map_generated(engine, options):
+  game = worldgen.generate(engine, rooms=options.rooms, seed=options.seed).game
+  game.output = engine.NullSink()
+  return Case(lambda: MapExporter(game).export(io.StringIO(), "dot"))
+
+
+# Macrobenchmarks.  These replay a whole transcript in a new game, and only
+# time the replay.
+
+def bench_replay_wander(engine, options):
+  commands = wander(engine, build_quietly(engine), options.steps, options.seed)
+  def run():
+    return replay(engine, commands, game=build_quietly(engine)).total_time()
+  return Case(run, len(commands), timed_inside=True)
+
+def bench_replay_playthrough(engine, options):
+  engine = load_engine("task2")
+  commands = read_transcript(os.path.join(os.path.dirname(os.path.abspath(__file__)), "playthrough.txt"))
+  def run():
+    return replay(engine, commands).total_time()
+  return Case(run, len(commands), timed_inside=True)
+
+def bench_replay_generated(engine, options):
+  def generate():
+    return worldgen.generate(engine, rooms=options.rooms, seed=options.seed)
+  commands = generate().solution
+  def run():
+    return replay(engine, commands, game=generate().game).total_time()
+  return Case(run, len(commands), timed_inside=True)
+
+def bench_replay_generated_wander(engine, options):
+  def generate():
+    return worldgen.generate(engine, rooms=options.rooms, seed=options.seed).game
+  commands = wander(engine, generate(), options.steps, options.seed)
+  def run():
+    return replay(engine, commands, game=generate()).total_time()
+  return Case(run, len(commands), timed_inside=True)
+
+
+# List of (name, group, setup function) for every benchmark, in the order
+# they are run.
+BENCHMARKS = [
+  ("parser.get_player_intent", "micro", bench_player_intent),
+] + [
+  ("parser.parse_command.%s" % intent, "micro", bench_parse_command(intent))
+  for intent in INTENT_COMMANDS
+] + [
+  ("preconditions.check_preconditions", "micro", bench_check_preconditions),
+  ("movement.is_blocked", "micro", bench_is_blocked),
+  ("world.add_connection", "micro", bench_add_connection),
+  ("world.add_connections", "micro", bench_add_connections),
+  ("world.build_game.task1", "micro", bench_build_game("task1")),
+  ("world.build_game.task2", "micro", bench_build_game("task2")),
+  ("map.export", "micro", bench_map),
+  ("map.export_generated", "micro", bench_map_generated),
+  ("replay.wander", "macro", bench_replay_wander),
+  ("replay.playthrough", "macro", bench_replay_playthrough),
+  ("replay.generated_solution", "macro", bench_replay_generated),
+  ("replay.generated_wander", "macro", bench_replay_generated_wander),
+]
+
+
+def run_benchmarks(engine, options, report=None):
+  """Run the benchmarks whose names contain options.filter, and return a
+     list of Results.  The report function is called with each result as it
+     finishes."""
+  engine = load_engine(engine)
+  results = []
+  for name, group, setup in BENCHMARKS:
+    if options.filter and options.filter not in name:
+      continue
+    case = setup(engine, options)
+    result = run_case(name, group, case, options.runs, options.min_time)
+    results.append(result)
+    if report:
+      report(result)
+  return results
+
+
+def git_revision():
+  """Returns the git commit of the working tree, or None."""
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                          text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def as_json(engine, options, results):
+  return {
+    "engine": load_engine(engine).__name__,
+    "revision": git_revision(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "options": {"rooms": options.rooms, "steps": options.steps, "seed": options.seed,
+                "runs": options.runs},
+    "results": [result.as_dict() for result in results],
+  }
+
+
+def compare(results, baseline, threshold):
+  """Print how the median of each result changed since a baseline, given as
+     the JSON of an earlier run.  Returns the names of the benchmarks that
+     got slower by more than the threshold, as a ratio."""
+  before = {result["name"]: result["median"] for result in baseline["results"]}
+  slower = []
+  for result in results:
+    if result.name not in before:
+      continue
+    ratio = result.median() / before[result.name]
+    print("%-40s %10.3f us -> %10.3f us  %5.2fx" % (
+      result.name, before[result.name] * 1e6, result.median() * 1e6, ratio))
+    if ratio > threshold:
+      slower.append(result.name)
+  return slower
+
+
+def format_result(result):
+  return "%-40s %10.3f us/op  (min %.3f, %d ops x %d runs)" % (
+    result.name, result.median() * 1e6, min(result.samples) * 1e6,
+    result.operations, len(result.samples))
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Benchmark the game engine.")
+  arg_parser.add_argument("engine", nargs="?", default="task1", help="game module to benchmark, e.g. task1 or task2")
+  arg_parser.add_argument("--filter", help="only run benchmarks whose names contain this")
+  arg_parser.add_argument("--runs", type=int, default=5, help="times to run each benchmark")
+  arg_parser.add_argument("--min-time", type=float, default=0.05, help="shortest run of a microbenchmark, in seconds")
+  arg_parser.add_argument("--rooms", type=int, default=2000, help="rooms in the generated world")
+  arg_parser.add_argument("--steps", type=int, default=2000, help="commands in the random walks")
+  arg_parser.add_argument("--seed", type=int, default=0, help="seed for the generated world and walks")
+  arg_parser.add_argument("--json", help="write the results as JSON to this path, or - for stdout")
+  arg_parser.add_argument("--compare", help="compare against the JSON of an earlier run")
+  arg_parser.add_argument("--threshold", type=float, default=1.25, help="slowdown that counts as a regression")
+  args = arg_parser.parse_args(argv)
+
+  quiet = args.json == "-"
+  results = run_benchmarks(args.engine, args, None if quiet else lambda result: print(format_result(result)))
+  if args.json:
+    data = as_json(args.engine, args, results)
+    if quiet:
+      json.dump(data, sys.stdout, indent=2)
+      print()
+    else:
+      with open(args.json, "w") as f:
+        json.dump(data, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    slower = compare(results, baseline, args.threshold)
+    if slower:
+      print("Slower than %.2fx: %s" % (args.threshold, ", ".join(slower)))
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,270 @@
+"""Write out the map of a game as it is walked, in DOT, JSON or GraphML.
+
+The MapExporter here writes a record for each location and each connection
+to a file as soon as it reaches them, so the map of a very large world takes
+little more memory than the world itself.  `visualize()` in the game modules
+is a wrapper around it that returns the DOT output as a graphviz Source.  Blocks are checked as
+if the player were standing in the location, the way the game's path finder
+does: the player is put there only for the check, which isn't recorded as a
+move, and the answers come from the game's block cache.
+
+The formats are:
+
+* dot: a GraphViz digraph, which is what `visualize()` returns.
+* json: JSON Lines, with one {"type": "node", ...} or {"type": "edge", ...}
+  record per line.
+* graphml: GraphML, with the names, descriptions and items of the
+  locations and the directions and blocks of the connections as data.
+
+An exporter remembers what it wrote.  Exporting again with
+`changed_only=True` only writes the locations whose `version` has changed
+since then, or whose blocks now let the player through where they didn't
+before (or the other way around), along with the connections out of them.
+The blocks of a location are only tested again if one of the facts they
+depend on has changed.  A connection can lead to a location that isn't
+written again, so each of those is written as a stub, with just its id and
+name, which keeps DOT and GraphML output valid on its own.  A location is
+the unit that is written again; changing a location's description directly
+doesn't change its version.
+
+```
+python3 mapexport.py task1 --format dot | dot -Tpng > map.png
+python3 mapexport.py task1 --world worlds/action_castle.json --format json
+python3 mapexport.py task1 --generate 100000 --format graphml -o big.graphml
+```
+"""
+
+import argparse
+import json
+import sys
+from xml.sax.saxutils import escape
+
+from replay import load_engine
+
+
+class DotWriter:
+  """Writes the map as a GraphViz digraph."""
+  def __init__(self, out):
+    self.out = out
+
+  def begin(self):
+    self.out.write("digraph map {\n  node [color=lightblue2, style=filled];\n")
+
+  def node(self, record):
+    items = ""
+    for item in record["items"]:
+      items += "<br/>" + escape(item["description"])
+      for command in item.get("commands", ()):
+        items += "<br/><i>%s</i>" % escape(command)
+    if items:
+      items = "You see:" + items
+    self.out.write('  n%d [label=<<b>%s</b><br />%s<br />%s>];\n' % (
+      record["id"], escape(record["name"]), escape(record["description"]), items))
+
+  def stub(self, record):
+    self.out.write('  n%d [label=<<b>%s</b>>, style=dashed];\n' % (record["id"], escape(record["name"])))
+
+  def edge(self, record):
+    label = record["direction"].capitalize()
+    if record["blocked"]:
+      label += "\n" + record["block_description"]
+      self.out.write("  n%d -> n%d [label=%s, style=dotted];\n" % (
+        record["source"], record["target"], json.dumps(label)))
+    else:
+      self.out.write("  n%d -> n%d [label=%s];\n" % (
+        record["source"], record["target"], json.dumps(label)))
+
+  def end(self):
+    self.out.write("}\n")
+
+
+class JsonWriter:
+  """Writes the map as JSON Lines, one record per line."""
+  def __init__(self, out):
+    self.out = out
+
+  def begin(self):
+    pass
+
+  def node(self, record):
+    self.out.write(json.dumps(dict(record, type="node")) + "\n")
+
+  def stub(self, record):
+    self.out.write(json.dumps(dict(record, type="stub")) + "\n")
+
+  def edge(self, record):
+    self.out.write(json.dumps(dict(record, type="edge")) + "\n")
+
+  def end(self):
+    pass
+
+
+class GraphMLWriter:
+  """Writes the map as GraphML."""
+  # The (id, element, name, type) of each kind of data.
+  KEYS = [("name", "node", "name", "string"),
+          ("description", "node", "description", "string"),
+          ("items", "node", "items", "string"),
+          ("direction", "edge", "direction", "string"),
+          ("blocked", "edge", "blocked", "boolean"),
+          ("block_description", "edge", "block_description", "string")]
+
+  def __init__(self, out):
+    self.out = out
+
+  def begin(self):
+    self.out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+    for key, element, name, kind in self.KEYS:
+      self.out.write('  <key id="%s" for="%s" attr.name="%s" attr.type="%s"/>\n' % (
+        key, element, name, kind))
+    self.out.write('  <graph id="map" edgedefault="directed">\n')
+
+  def node(self, record):
+    items = ", ".join(item["description"] for item in record["items"])
+    self.out.write('    <node id="n%d"><data key="name">%s</data><data key="description">%s</data>'
+                   '<data key="items">%s</data></node>\n' % (
+      record["id"], escape(record["name"]), escape(record["description"]), escape(items)))
+
+  def stub(self, record):
+    self.out.write('    <node id="n%d"><data key="name">%s</data></node>\n' % (
+      record["id"], escape(record["name"])))
+
+  def edge(self, record):
+    self.out.write('    <edge source="n%d" target="n%d"><data key="direction">%s</data>'
+                   '<data key="blocked">%s</data>' % (
+      record["source"], record["target"], escape(record["direction"]),
+      "true" if record["blocked"] else "false"))
+    if "block_description" in record:
+      self.out.write('<data key="block_description">%s</data>' % escape(record["block_description"]))
+    self.out.write("</edge>\n")
+
+  def end(self):
+    self.out.write("  </graph>\n</graphml>\n")
+
+
+# Dictionary mapping from the name of each format to its writer.
+WRITERS = {"dot": DotWriter, "json": JsonWriter, "graphml": GraphMLWriter}
+
+
+class MapExporter:
+  """Writes the map of a game, and remembers what it wrote so that later
+     exports can leave out the locations that haven't changed."""
+  def __init__(self, game, print_commands=True):
+    self.game = game
+    # Include the special commands of the items.
+    self.print_commands = print_commands
+    # Dictionary mapping from each location that has been written to its
+    # version and which of its blocks were in the way when it was written.
+    self.written = {}
+
+  def export(self, out, format="dot", changed_only=False):
+    """Write the map to a file in the given format.  If changed_only is True
+       only the locations that have changed since the last export are
+       written, and the other ends of their connections are written as stubs
+       if they aren't.  Returns the number of locations written."""
+    game = self.game
+    writer = WRITERS[format](out)
+    game.index_world()
+    count = 0
+    # The locations written this time, and the ones their connections lead
+    # to, by id.
+    written = set()
+    targets = {}
+    writer.begin()
+    # game.locations grows while it is being walked, if connections lead
+    # to locations that haven't been given ids yet.
+    for location in game.locations:
+      blocked = self.blocked_directions(location)
+      state = (location.version, blocked)
+      if changed_only and self.written.get(location) == state:
+        continue
+      self.written[location] = state
+      writer.node(self.node_record(location))
+      written.add(location.id)
+      for direction, next_location in location.connections.items():
+        if next_location.id is None:
+          game.index_world(next_location)
+        writer.edge(self.edge_record(location, direction, next_location, blocked))
+        if changed_only:
+          targets[next_location.id] = next_location
+      count += 1
+    for location_id in sorted(targets.keys() - written):
+      writer.stub({"id": location_id, "name": targets[location_id].name})
+    writer.end()
+    return count
+
+  def blocked_directions(self, location):
+    """Returns the directions out of the location that are blocked, as if
+       the player were standing there.  The answers come from the game's
+       block cache, so blocks are only tested again when something they
+       depend on has changed."""
+    if not location.blocks:
+      return ()
+    game = self.game
+    player_location = game._curr_location
+    game._curr_location = location
+    try:
+      return tuple(direction for direction in location.blocks
+                   if direction in location.connections and game.is_blocked(location, direction))
+    finally:
+      game._curr_location = player_location
+
+  def node_record(self, location):
+    items = []
+    for item in location.items.values():
+      record = {"name": item.name, "description": item.description}
+      if self.print_commands:
+        record["commands"] = list(item.get_commands())
+      items.append(record)
+    return {"id": location.id, "name": location.name, "description": location.description,
+            "end_game": location.end_game, "items": items}
+
+  def edge_record(self, location, direction, next_location, blocked):
+    record = {"source": location.id, "target": next_location.id, "direction": direction,
+              "blocked": direction in blocked}
+    if direction in location.blocks:
+      record["block_description"] = location.blocks[direction][0]
+    travel_description = location.travel_descriptions.get(direction)
+    if travel_description:
+      record["travel_description"] = travel_description
+    return record
+
+
+def export_map(game, out, format="dot", print_commands=True):
+  """Write the whole map of a game to a file.  Returns the MapExporter, which
+     can write what changes later."""
+  exporter = MapExporter(game, print_commands)
+  exporter.export(out, format)
+  return exporter
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Write the map of a game.")
+  arg_parser.add_argument("engine", help="game module, e.g. task1 or task2")
+  arg_parser.add_argument("--format", choices=sorted(WRITERS), default="dot", help="format to write")
+  arg_parser.add_argument("--world", help="world file to map instead of the game's own world")
+  arg_parser.add_argument("--generate", type=int, metavar="ROOMS", help="map a generated world with this many rooms")
+  arg_parser.add_argument("--seed", type=int, default=0, help="seed for the generated world")
+  arg_parser.add_argument("-o", "--output", help="file to write to, instead of stdout")
+  args = arg_parser.parse_args(argv)
+
+  engine = load_engine(args.engine)
+  if args.world:
+    from worldfile import load_world
+    game = load_world(engine, args.world, lazy=False)
+  elif args.generate:
+    import worldgen
+    game = worldgen.generate(engine, rooms=args.generate, items=args.generate // 2,
+                             gates=args.generate // 100, seed=args.seed).game
+  else:
+    game = engine.build_game()
+  if args.output:
+    with open(args.output, "w") as out:
+      export_map(game, out, args.format)
+  else:
+    export_map(game, sys.stdout, args.format)
+
+
+if __name__ == "__main__":
+  main()
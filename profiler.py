@@ -0,0 +1,192 @@
+"""Find out where the time of each command goes.
+
+A game keeps track of how long the phases of its commands take when it has
+a Profiler in `game.profiler`.  With no profiler, which is the default, the
+engine only checks that the attribute is None.  The phases are:
+
+* command: the whole of `Parser.parse_command`, for the commands the player
+  typed (not the parts of a comma separated sequence).
+* intent: working out what the player intends, in `parse_command` and
+  `Parser.get_player_intent`.
+* run: carrying out the intent.
+* preconditions: testing the preconditions of an action or a block, in
+  `test_preconditions`.  A block's result is cached by `Game.is_blocked`
+  until something it depends on changes, so only the tests that run count.
+* action: the special function of an item, in `Item.do_action`, once its
+  preconditions are met.
+* describe: `Game.describe`.
+* output: writing out what the command printed.
+
+The time of each phase goes into a histogram with fixed buckets, so
+recording a time is a search over a short list and an increment, and memory
+doesn't grow however many commands are run.  There are also counters of the
+commands run with each intent, and of the preconditions that failed.
+
+A profiler can be read as a snapshot, or as text in the Prometheus
+exposition format, and `serve()` makes both available over HTTP on a local
+port, at `/metrics` and `/snapshot`:
+
+```
+profiler = Profiler()
+profiler.attach(game)
+serve(profiler, port=8701)
+```
+"""
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The upper bounds of the histogram buckets, in seconds: from a microsecond
+# to ten seconds, doubling each time.  Slower times go in a last bucket.
+BUCKETS = tuple(1e-6 * 2 ** power for power in range(24))
+
+# The label that each counter's values are exported with.
+COUNTER_LABELS = {"commands": "intent"}
+
+
+class Histogram:
+  """Counts of how many times fell into each of the buckets."""
+  __slots__ = ("counts", "total", "count")
+
+  def __init__(self):
+    # The number of times in each bucket, and then the number that were
+    # slower than the last bucket.
+    self.counts = [0] * (len(BUCKETS) + 1)
+    # The sum of all of the times, in seconds.
+    self.total = 0.0
+    # The number of times.
+    self.count = 0
+
+  def observe(self, seconds):
+    self.counts[bisect_left(BUCKETS, seconds)] += 1
+    self.total += seconds
+    self.count += 1
+
+  def percentile(self, fraction):
+    """Returns the upper bound of the bucket that the given fraction of the
+       times fall within, or None if there are none."""
+    if not self.count:
+      return None
+    needed = fraction * self.count
+    seen = 0
+    for bound, count in zip(BUCKETS, self.counts):
+      seen += count
+      if seen >= needed:
+        return bound
+    return float("inf")
+
+  def as_dict(self):
+    return {
+      "count": self.count,
+      "sum": self.total,
+      "mean": self.total / self.count if self.count else None,
+      "p50": self.percentile(0.5),
+      "p99": self.percentile(0.99),
+      "buckets": [[bound, count] for bound, count in zip(BUCKETS + (float("inf"),), self.counts)
+                  if count],
+    }
+
+
+class Profiler:
+  """Histograms of how long each phase of the commands took, and counters
+     of what happened."""
+  def __init__(self, clock=time.perf_counter):
+    # The function that the engine gets the time from, in seconds.
+    self.clock = clock
+    # Dictionary mapping from the name of a phase to its Histogram.
+    self.histograms = {}
+    # Dictionary mapping from the name of a counter to a dictionary of its
+    # label values and their counts.
+    self.counters = {}
+
+  def attach(self, game):
+    """Start profiling the commands of a game."""
+    game.profiler = self
+    return self
+
+  def observe(self, phase, seconds):
+    """Record how long a phase took."""
+    histogram = self.histograms.get(phase)
+    if histogram is None:
+      histogram = self.histograms[phase] = Histogram()
+    histogram.observe(seconds)
+
+  def count(self, name, label=""):
+    """Add one to a counter, for the given value of its label."""
+    counter = self.counters.get(name)
+    if counter is None:
+      counter = self.counters[name] = {}
+    counter[label] = counter.get(label, 0) + 1
+
+  def reset(self):
+    self.histograms = {}
+    self.counters = {}
+
+  def snapshot(self):
+    """Returns everything that has been recorded as a dictionary that can be
+       written as JSON."""
+    return {
+      "phases": {phase: histogram.as_dict()
+                 for phase, histogram in sorted(self.histograms.items())},
+      "counters": {name: dict(counter) for name, counter in sorted(self.counters.items())},
+    }
+
+  def prometheus(self, prefix="game"):
+    """Returns everything that has been recorded in the Prometheus text
+       exposition format."""
+    lines = ["# HELP %s_phase_seconds Time spent in each phase of a command." % prefix,
+             "# TYPE %s_phase_seconds histogram" % prefix]
+    for phase, histogram in sorted(self.histograms.items()):
+      cumulative = 0
+      for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append('%s_phase_seconds_bucket{phase="%s",le="%g"} %d' % (prefix, phase, bound, cumulative))
+      lines.append('%s_phase_seconds_bucket{phase="%s",le="+Inf"} %d' % (prefix, phase, histogram.count))
+      lines.append('%s_phase_seconds_sum{phase="%s"} %r' % (prefix, phase, histogram.total))
+      lines.append('%s_phase_seconds_count{phase="%s"} %d' % (prefix, phase, histogram.count))
+    for name, counter in sorted(self.counters.items()):
+      lines.append("# TYPE %s_%s_total counter" % (prefix, name))
+      label = COUNTER_LABELS.get(name)
+      for value, count in sorted(counter.items()):
+        if label:
+          lines.append('%s_%s_total{%s="%s"} %d' % (prefix, name, label, value, count))
+        else:
+          lines.append("%s_%s_total %d" % (prefix, name, count))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+  """Answers requests for /metrics and /snapshot with the server's
+     profiler."""
+  def do_GET(self):
+    profiler = self.server.profiler
+    if self.path == "/metrics":
+      body = profiler.prometheus().encode("utf-8")
+      content_type = "text/plain; version=0.0.4; charset=utf-8"
+    elif self.path == "/snapshot":
+      body = json.dumps(profiler.snapshot()).encode("utf-8")
+      content_type = "application/json"
+    else:
+      self.send_error(404)
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def serve(profiler, host="127.0.0.1", port=8701):
+  """Serve the profiler's metrics over HTTP from a background thread.
+     Returns the HTTP server, which can be stopped with shutdown()."""
+  server = ThreadingHTTPServer((host, port), MetricsHandler)
+  server.profiler = profiler
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  return server
@@ -0,0 +1,151 @@
+"""Replay transcripts of commands against a game without a player.
+
+A transcript is a text file with one command per line, like
+`playthrough.txt`.  Each transcript is fed through `Parser.parse_command`
+of a freshly started game, and the output that the game would have printed
+is either collected with a ListSink or thrown away with a NullSink.  The
+result records where the player ended up, whether the game ended, and how
+long each command took, so that transcripts can be used as regression tests
+and as benchmarks.
+
+Run it from the command line with the game module and one or more
+transcripts:
+
+```
+python3 replay.py task2 playthrough.txt
+```
+"""
+
+import argparse
+import importlib
+import json
+import sys
+import time
+
+
+class ReplayResult:
+  """The outcome of replaying one transcript."""
+  def __init__(self, name):
+    # The name of the transcript that was replayed.
+    self.name = name
+    # The commands that were run, in order.
+    self.commands = []
+    # How long each command took, in seconds.
+    self.timings = []
+    # True if one of the commands ended the game.
+    self.ended = False
+    # The name of the location the player finished in.
+    self.location = None
+    # The names of the items in the player's inventory at the end.
+    self.inventory = []
+    # Everything the game printed, if the output was captured.
+    self.output = None
+
+  def total_time(self):
+    return sum(self.timings)
+
+  def as_dict(self):
+    return {
+      "transcript": self.name,
+      "commands": len(self.commands),
+      "ended": self.ended,
+      "location": self.location,
+      "inventory": self.inventory,
+      "total_time": self.total_time(),
+      "timings": [
+        {"command": command, "seconds": seconds}
+        for command, seconds in zip(self.commands, self.timings)
+      ],
+    }
+
+
+def load_engine(engine):
+  """Returns the game module for a module name like "task1", or the module
+     itself if it has already been imported."""
+  if isinstance(engine, str):
+    return importlib.import_module(engine)
+  return engine
+
+
+def read_transcript(transcript):
+  """Returns the commands in a transcript, which may be a path, an open file
+     or a list of lines.  Blank lines are skipped."""
+  if isinstance(transcript, str):
+    with open(transcript) as f:
+      return read_transcript(f)
+  return [line.strip() for line in transcript if line.strip()]
+
+
+def replay(engine, commands, name="<commands>", capture=False, game=None,
+           profiler=None):
+  """Start a new game from the engine module and run each of the commands
+     through the parser, stopping early if the game ends.  The game is built
+     with the engine's build_game() unless one is given.  If capture is True
+     the game's output is kept in the result, otherwise it is discarded.  If
+     a profiler is given, it records the phases of the commands."""
+  engine = load_engine(engine)
+  result = ReplayResult(name)
+  timer = time.perf_counter
+  if game is None:
+    game = engine.build_game()
+  game.output = engine.ListSink() if capture else engine.NullSink()
+  game.profiler = profiler
+  parser = engine.Parser(game)
+  game.describe()
+  game.output.flush()
+  for command in commands:
+    start = timer()
+    end_game = parser.parse_command(command)
+    result.timings.append(timer() - start)
+    result.commands.append(command)
+    if end_game:
+      result.ended = True
+      break
+  result.location = game.curr_location.name
+  result.inventory = list(game.inventory)
+  if capture:
+    result.output = game.output.getvalue()
+  return result
+
+
+def replay_all(engine, transcripts, capture=False, profiler=None):
+  """Replay each of a stream of transcripts in a new game, yielding a result
+     for each one as it finishes."""
+  engine = load_engine(engine)
+  for transcript in transcripts:
+    if transcript == "-":
+      yield replay(engine, read_transcript(sys.stdin), "<stdin>", capture, profiler=profiler)
+    else:
+      yield replay(engine, read_transcript(transcript), str(transcript), capture, profiler=profiler)
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Replay command transcripts against a game.")
+  arg_parser.add_argument("engine", help="game module to play, e.g. task1 or task2")
+  arg_parser.add_argument("transcripts", nargs="+", help="transcript files, or - for stdin")
+  arg_parser.add_argument("--show-output", action="store_true", help="print what the game printed")
+  arg_parser.add_argument("--json", action="store_true", help="write the results as JSON lines")
+  arg_parser.add_argument("--repeat", type=int, default=1, help="replay each transcript this many times")
+  arg_parser.add_argument("--profile", action="store_true", help="print how long each phase of the commands took")
+  args = arg_parser.parse_args(argv)
+
+  profiler = None
+  if args.profile:
+    from profiler import Profiler
+    profiler = Profiler()
+  transcripts = [t for t in args.transcripts for _ in range(args.repeat)]
+  for result in replay_all(args.engine, transcripts, args.show_output, profiler):
+    if args.show_output:
+      print(result.output, end="")
+    if args.json:
+      print(json.dumps(result.as_dict()))
+    else:
+      print("%s: %d commands, ended=%s, location=%s, %.3f ms" % (
+        result.name, len(result.commands), result.ended, result.location,
+        result.total_time() * 1000))
+  if profiler:
+    print(profiler.prometheus(), end="")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,176 @@
+"""Host a game for many players at once over TCP.
+
+Each connection plays its own game.  The world is built once, with the
+engine module's `build_game()`, as a WorldTemplate, and each connection gets
+an Overlay on it that holds only what its commands have changed (see
+template.py).  The protocol is plain lines of text:
+the player sends one command per line, and the server answers with whatever
+the game printed, followed by a `>` prompt.  Sending `exit` or `quit`, or
+closing the connection, ends the session.
+
+All of the sessions run in one process on an asyncio event loop.  Commands
+are run one at a time, since the engine is synchronous, and the output of
+each command is sent to the connection in one write by an AsyncSink.  Memory per
+session is bounded by limiting the length of a command, the number of steps
+that can be undone, and how long a connection can sit idle.
+
+With `--metrics-port`, how long each phase of the commands takes is served
+as Prometheus metrics over HTTP (see profiler.py).
+
+Run it from the command line with the game module, then connect with a tool
+like `nc localhost 8700`:
+
+```
+python3 server.py task1 --port 8700
+```
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+
+from template import WorldTemplate
+
+logger = logging.getLogger("server")
+
+# Commands that end a session without ending the game.
+QUIT_COMMANDS = ("exit", "quit", "q")
+
+
+class Session:
+  """One player's game, as an overlay on the server's shared world, whose
+     output is written to the player's connection."""
+  def __init__(self, template, writer):
+    self.output = template.engine.AsyncSink(writer)
+    self.overlay = template.new_session(self.output)
+    # True once a command has ended the game.
+    self.ended = False
+
+  def start(self):
+    """Describe where the player starts."""
+    self.overlay.describe()
+
+  def run_command(self, command):
+    """Run one command, sending the game's response to the player in a
+       single write, along with the end of the game if the command ended
+       it."""
+    self.output.held = True
+    try:
+      self.ended = self.overlay.run_command(command)
+      if self.ended:
+        self.output.print("THE GAME HAS ENDED.")
+    finally:
+      self.output.held = False
+      self.output.flush()
+
+  def close(self):
+    self.overlay.close()
+
+
+class GameServer:
+  """Accepts connections and plays a separate game with each of them."""
+  def __init__(self, engine, max_sessions=10000, idle_timeout=600,
+               max_command_length=1024, history_limit=100):
+    # The world that all of the sessions share, where each player can undo
+    # up to history_limit commands.
+    self.template = WorldTemplate(engine, history_limit)
+    self.engine = self.template.engine
+    # The most connections that can be playing at once.  Players that
+    # connect when the server is full are turned away.
+    self.max_sessions = max_sessions
+    # Seconds a player can go without sending a command before they are
+    # disconnected, or None to wait forever.
+    self.idle_timeout = idle_timeout
+    # The longest line that a player can send, in bytes.
+    self.max_command_length = max_command_length
+    # The number of sessions being played right now.
+    self.session_count = 0
+
+  async def start(self, host="127.0.0.1", port=8700):
+    """Start listening for players.  Returns the asyncio server."""
+    return await asyncio.start_server(self.handle_connection, host, port,
+                                      limit=self.max_command_length)
+
+  async def serve_forever(self, host="127.0.0.1", port=8700):
+    server = await self.start(host, port)
+    for socket in server.sockets:
+      logger.info("Serving %s on %s", self.engine.__name__, socket.getsockname())
+    async with server:
+      await server.serve_forever()
+
+  async def handle_connection(self, reader, writer):
+    """Play one game with a connected player."""
+    if self.session_count >= self.max_sessions:
+      writer.write(b"The server is full.  Please try again later.\n")
+      await self.close(writer)
+      return
+    self.session_count += 1
+    session = Session(self.template, writer)
+    try:
+      session.start()
+      await self.prompt(writer)
+      while not session.ended:
+        command = await self.read_command(reader)
+        if command is None or command.lower() in QUIT_COMMANDS:
+          break
+        session.run_command(command)
+        await self.prompt(writer, not session.ended)
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    except Exception:
+      logger.exception("Session ended by an error")
+    finally:
+      self.session_count -= 1
+      session.close()
+      await self.close(writer)
+
+  async def read_command(self, reader):
+    """Returns the next command from the player, or None if they have gone
+       away, been idle for too long, or sent a line that is too long."""
+    try:
+      line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+    except (asyncio.TimeoutError, ValueError):
+      return None
+    if not line:
+      return None
+    return line.decode("utf-8", errors="replace").strip()
+
+  async def prompt(self, writer, prompt=True):
+    """Prompt the player for their next command, and wait until everything
+       has been sent."""
+    if prompt:
+      writer.write(b">")
+    await writer.drain()
+
+  async def close(self, writer):
+    writer.close()
+    with contextlib.suppress(ConnectionError):
+      await writer.wait_closed()
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Host a game for many players over TCP.")
+  arg_parser.add_argument("engine", help="game module to play, e.g. task1 or task2")
+  arg_parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+  arg_parser.add_argument("--port", type=int, default=8700, help="port to listen on")
+  arg_parser.add_argument("--max-sessions", type=int, default=10000, help="most players at once")
+  arg_parser.add_argument("--idle-timeout", type=float, default=600, help="seconds before an idle player is disconnected")
+  arg_parser.add_argument("--metrics-port", type=int, help="serve profiling metrics over HTTP on this port")
+  args = arg_parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO)
+  server = GameServer(args.engine, max_sessions=args.max_sessions,
+                      idle_timeout=args.idle_timeout)
+  if args.metrics_port:
+    from profiler import Profiler, serve
+    serve(Profiler().attach(server.template.game), args.host, args.metrics_port)
+    logger.info("Serving metrics on port %d", args.metrics_port)
+  try:
+    asyncio.run(server.serve_forever(args.host, args.port))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,417 @@
+"""Solve a game by searching the space of world states.
+
+The solver starts from a freshly built game and does a breadth-first search
+over world states.  A state is the player's location together with where
+every item is: in a location, in the inventory, or nowhere, as exported by
+Game.export_state().  From each state it tries every command that could
+change the world (moving in each direction, taking the items that something
+in the game mentions, dropping items that a precondition needs to find in a
+location, and the special commands of the items in scope), runs it through
+the parser as a dry run, and records the state it leads to.
+
+The search finds the shortest sequence of commands that wins the game, the
+commands that end the game without winning, and the dead ends: states from
+which the game can no longer be won.
+
+Run it from the command line with the game module:
+
+```
+python3 solver.py task1
+```
+
+Large worlds can be searched with several processes by adding
+`--processes N`, and the world can come from a world file (or its compiled
+cache) instead of the game module's build_game():
+
+```
+python3 solver.py task1 --world big.json --processes 4
+```
+"""
+
+import argparse
+import multiprocessing
+import time
+from array import array
+from collections import deque
+
+from replay import load_engine
+
+# Outcomes of commands that end the game.
+WON = "won"
+LOST = "lost"
+
+
+class World:
+  """The world of a game as the solver sees it.  States are the compact
+     snapshots from Game.export_state(), except that the visited bitset only
+     has the locations that some `visited` precondition checks.  Whether the
+     player has been anywhere else doesn't change what they can do."""
+  def __init__(self, game):
+    self.game = game
+    game.index_world()
+    self.locations = game.locations
+    self.items = game.items
+    # The ids of items that a precondition needs to be in some location.
+    # Dropping any other item can't make a difference to what the player can
+    # do, so the search doesn't try it.
+    self.needed_in_location = set()
+    # The locations that a precondition needs the player to have visited.
+    self.visited_locations = set()
+    # The names of the items that preconditions or the arguments of actions
+    # mention.
+    self.mentioned_names = set()
+    for location in self.locations:
+      for block_description, preconditions in location.blocks.values():
+        self.add_preconditions(preconditions)
+        self.add_mentions(preconditions)
+    for item in self.items:
+      for function, arguments, preconditions in item.commands.values():
+        self.add_preconditions(preconditions)
+        self.add_mentions((arguments, preconditions))
+    # The ids of items that taking might make a difference to: the ones that
+    # are mentioned (or share a name with one that is), that end the game
+    # when taken, or that have special commands.  Carrying anything else
+    # can't change what the player can do, so the search doesn't take it.
+    self.worth_taking = set(item.id for item in self.items
+                            if item.name in self.mentioned_names or item.end_game or item.commands)
+    # The state that the world is in.
+    self.state = self.get_state()
+
+  def add_preconditions(self, preconditions):
+    """Find the items that the preconditions need to be in a location, given
+       either compiled Preconditions or the dictionary they came from."""
+    for check, value in getattr(preconditions, "source", preconditions).items():
+      if check.startswith("location_has_item"):
+        self.needed_in_location.add(value.id)
+      elif check.startswith("item_in_location"):
+        self.needed_in_location.add(value[0].id)
+      elif check.startswith("visited"):
+        self.visited_locations.add(value)
+      elif check == "not":
+        self.add_preconditions(value)
+      elif check == "any_of":
+        for alternative in value:
+          self.add_preconditions(alternative)
+
+  def add_mentions(self, thing):
+    """Find the names of the items mentioned anywhere in preconditions or in
+       the arguments of actions, including the actions that are run by other
+       actions."""
+    items = set(self.items)
+    frontier = [thing]
+    while frontier:
+      thing = frontier.pop()
+      if isinstance(thing, (tuple, list, set)):
+        frontier.extend(thing)
+      elif isinstance(thing, dict):
+        frontier.extend(thing.values())
+      elif hasattr(thing, "source"):
+        frontier.append(thing.source)
+      elif thing in items:
+        self.mentioned_names.add(thing.name)
+
+  def get_state(self):
+    """Returns the current state of the world as a hashable tuple."""
+    location, placements, visited = self.game.export_state(include_visited=False)
+    visited = 0
+    for visited_location in self.visited_locations:
+      if visited_location.has_been_visited:
+        visited |= 1 << visited_location.id
+    return (location, placements, visited)
+
+  def set_state(self, state):
+    """Move the player and the items so that the world is in the state, and
+       mark the locations that preconditions check as visited or not.  Only
+       what differs from the state the world is in now is changed."""
+    location, placements, visited = state
+    if state != self.state:
+      self.game.restore_state((location, placements, None), current=self.state)
+      if visited != self.state[2]:
+        for visited_location in self.visited_locations:
+          self.game.set_visited(visited_location, bool(visited >> visited_location.id & 1))
+      self.state = state
+    self.game.won = False
+
+  def next_state(self, changes):
+    """Returns the state that the world is in after the changes recorded in
+       the history (see Game.note_change) were made to the current state.
+       Only the items that the changes touch are looked at, unless they
+       involve objects that the world hadn't given ids to before."""
+    location, placements, visited = self.state
+    moved = None
+    for change in changes:
+      kind = change[0]
+      if kind == "move":
+        location = change[2].id
+        if location is None:
+          return self.get_state()
+        continue
+      if kind == "visit" or kind == "unvisit":
+        if change[1] in self.visited_locations:
+          if kind == "visit":
+            visited |= 1 << change[1].id
+          else:
+            visited &= ~(1 << change[1].id)
+        continue
+      if moved is None:
+        moved = array("I")
+        moved.frombytes(placements)
+      if kind == "add_item" or kind == "remove_item":
+        where = change[1].id + 2
+      else:
+        where = 1
+      # A replaced item is only taken out if it was in the same place.
+      if kind == "add_item" or kind == "add_to_inventory":
+        item, taken_out = change[-2], change[-1]
+      else:
+        item, taken_out = None, change[-1]
+      for thing in (item, taken_out):
+        if thing is not None and (thing.id is None or thing.id >= len(moved)):
+          return self.get_state()
+      if taken_out is not None and moved[taken_out.id] == where:
+        moved[taken_out.id] = 0
+      if item is not None:
+        moved[item.id] = where
+    if moved is not None:
+      placements = moved.tobytes()
+    return (location, placements, visited)
+
+  def possible_commands(self):
+    """Returns the commands that might change the world from the current
+       state."""
+    game = self.game
+    commands = list(game.curr_location.connections)
+    for item in game.curr_location.items.values():
+      if item.gettable and item.id in self.worth_taking:
+        commands.append("take " + item.name)
+    for item in game.inventory.values():
+      if item.id in self.needed_in_location:
+        commands.append("drop " + item.name)
+    for item in game.get_items_in_scope():
+      commands.extend(item.get_commands())
+    return commands
+
+
+class Solution:
+  """The result of searching the states of a game."""
+  def __init__(self, world, start, find_dead_ends=True):
+    self.world = world
+    self.start = start
+    # Dictionary mapping from each state reached to its (parent, command).
+    self.parents = {start: None}
+    # Dictionary mapping from each state to the states that lead to it, or
+    # None if the dead ends aren't being looked for.
+    self.predecessors = {} if find_dead_ends else None
+    # The shortest list of commands that wins the game, or None.
+    self.moves = None
+    # Lists of (state, command) pairs for commands that end the game with a
+    # win or without one.
+    self.wins = []
+    self.game_overs = []
+    # States from which the game can no longer be won.
+    self.dead_ends = []
+    # How long the search took, in seconds.
+    self.elapsed = 0.0
+
+  def add(self, state, command, outcome):
+    """Record the outcome of running the command in the state.  Returns True
+       if the outcome is a state that hasn't been reached before."""
+    if outcome == WON:
+      self.wins.append((state, command))
+    elif outcome == LOST:
+      self.game_overs.append((state, command))
+    else:
+      if self.predecessors is not None:
+        self.predecessors.setdefault(outcome, []).append(state)
+      if outcome not in self.parents:
+        self.parents[outcome] = (state, command)
+        return True
+    return False
+
+  def finish(self, elapsed):
+    """Work out the winning moves and the dead ends once the search is over."""
+    if self.wins:
+      self.moves = self.path(*self.wins[0])
+    if self.predecessors is not None:
+      self.dead_ends = find_unwinnable(self.parents, self.predecessors, self.wins)
+    self.elapsed = elapsed
+
+  def path(self, state, command=None):
+    """Returns the list of commands that leads from the start to the state,
+       followed by the command if one is given."""
+    commands = [command] if command else []
+    while self.parents[state] is not None:
+      state, previous_command = self.parents[state]
+      commands.append(previous_command)
+    commands.reverse()
+    return commands
+
+  def describe(self, state):
+    """Returns a short human-readable description of a state."""
+    location, placements, visited = state
+    inventory = [item.name for item, placement in zip(self.world.items, array("I", placements))
+                 if placement == 1]
+    return "%s, holding %s" % (self.world.locations[location].name, ", ".join(inventory) or "nothing")
+
+
+def expand(world, parser, state):
+  """Yields a (command, outcome) pair for every command that might change
+     the world from the state.  The outcome is WON or LOST if the command
+     ends the game, and otherwise the state that the command leads to.
+     Commands that leave the world as it was are skipped.  Each command is
+     run as a dry run, so the world is back in the state afterwards."""
+  world.set_state(state)
+  next_state = lambda game: world.next_state(game.history.step)
+  for command in world.possible_commands():
+    result = parser.simulate(command, observe=next_state)
+    if result.end_game:
+      yield command, WON if result.won else LOST
+    elif result.observed != state:
+      yield command, result.observed
+
+
+def load_game(engine, world=None):
+  """Returns the game to search: the one built by the engine module's
+     build_game(), or the world in a world file if a path is given, loaded
+     completely.  A world file is loaded from its compiled cache (see
+     worldcache.py), which is made first if it isn't up to date, and a path
+     ending in .wcache is taken to be a compiled world already."""
+  engine = load_engine(engine)
+  if world is None:
+    game = engine.build_game()
+  else:
+    from worldcache import cached_world, open_compiled
+    from worldfile import load_world
+    source = open_compiled(world) if world.endswith(".wcache") else cached_world(world)
+    game = load_world(engine, source, lazy=False)
+  game.output = engine.NullSink()
+  return game
+
+
+def solve(engine, game=None, find_dead_ends=True, world=None):
+  """Search the states of a game for the shortest winning sequence of
+     commands.  Unless a game is given, it is loaded with load_game() from
+     the world file, if there is one, or the engine module's build_game().
+     If find_dead_ends is False the search stops as soon as a win is
+     found."""
+  engine = load_engine(engine)
+  if game is None:
+    game = load_game(engine, world)
+  game.output = engine.NullSink()
+  parser = engine.Parser(game)
+  world = World(game)
+  start_time = time.perf_counter()
+  solution = Solution(world, world.get_state(), find_dead_ends)
+  frontier = deque([solution.start])
+
+  while frontier:
+    state = frontier.popleft()
+    for command, outcome in expand(world, parser, state):
+      if solution.add(state, command, outcome):
+        frontier.append(outcome)
+    if solution.wins and not find_dead_ends:
+      break
+
+  solution.finish(time.perf_counter() - start_time)
+  return solution
+
+
+# The world that each worker process searches, set up by start_worker().
+worker_world = None
+worker_parser = None
+
+def start_worker(engine_name, world=None):
+  """Load a private copy of the world in a worker process, the same way as
+     the main process did.  Workers are only ever sent states, which are
+     tuples of integers and bytes, so none of the game's objects or
+     functions need to be pickled."""
+  global worker_world, worker_parser
+  engine = load_engine(engine_name)
+  game = load_game(engine, world)
+  worker_world = World(game)
+  worker_parser = engine.Parser(game)
+
+def expand_states(states):
+  """Expand a chunk of the frontier in a worker process."""
+  return [(state, list(expand(worker_world, worker_parser, state))) for state in states]
+
+
+def solve_parallel(engine, processes=None, find_dead_ends=True, world=None):
+  """Search the states of a game like solve(), but split each level of the
+     breadth-first search across a pool of worker processes.  Each worker
+     loads its own copy of the world with load_game(), from the world file
+     if a path is given, and the states they find are deduplicated here by
+     their hash before the next level is sent out.  The world file is
+     compiled before the workers start, so that they only have to map the
+     compiled cache.  The engine must be a module that the workers can
+     import."""
+  engine = load_engine(engine)
+  processes = processes or multiprocessing.cpu_count()
+  game = load_game(engine, world)
+  world_path = world
+  world = World(game)
+  start_time = time.perf_counter()
+  solution = Solution(world, world.get_state(), find_dead_ends)
+  frontier = [solution.start]
+
+  with multiprocessing.Pool(processes, start_worker, (engine.__name__, world_path)) as pool:
+    while frontier:
+      # Use several chunks per process so that a slow chunk doesn't leave the
+      # other processes idle at the end of a level.
+      size = max(1, len(frontier) // (processes * 4))
+      chunks = [frontier[i:i + size] for i in range(0, len(frontier), size)]
+      frontier = []
+      for expanded in pool.imap(expand_states, chunks):
+        for state, outcomes in expanded:
+          for command, outcome in outcomes:
+            if solution.add(state, command, outcome):
+              frontier.append(outcome)
+      if solution.wins and not find_dead_ends:
+        break
+
+  solution.finish(time.perf_counter() - start_time)
+  return solution
+
+
+def find_unwinnable(states, predecessors, wins):
+  """Returns the states from which none of the winning moves can be
+     reached, by searching backwards from the states that have a winning
+     move."""
+  winnable = set(state for state, command in wins)
+  frontier = deque(winnable)
+  while frontier:
+    state = frontier.popleft()
+    for previous in predecessors.get(state, ()):
+      if previous not in winnable:
+        winnable.add(previous)
+        frontier.append(previous)
+  return [state for state in states if state not in winnable]
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Find the shortest way to win a game.")
+  arg_parser.add_argument("engine", help="game module to solve, e.g. task1 or task2")
+  arg_parser.add_argument("--show-dead-ends", action="store_true", help="list the ways to get stuck")
+  arg_parser.add_argument("--processes", type=int, default=1, help="number of worker processes to search with")
+  arg_parser.add_argument("--world", help="world file, or compiled world, to solve instead of the game's own world")
+  args = arg_parser.parse_args(argv)
+
+  if args.processes > 1:
+    solution = solve_parallel(args.engine, args.processes, world=args.world)
+  else:
+    solution = solve(args.engine, world=args.world)
+  print("Explored %d states in %.1f ms." % (len(solution.parents), solution.elapsed * 1000))
+  if solution.moves:
+    print("Shortest win (%d commands):" % len(solution.moves))
+    for command in solution.moves:
+      print("  " + command)
+  else:
+    print("The game cannot be won.")
+  print("%d ways to lose, %d dead-end states." % (len(solution.game_overs), len(solution.dead_ends)))
+  if args.show_dead_ends:
+    for state in solution.dead_ends:
+      print("  %s: %s" % (solution.describe(state), ", ".join(solution.path(state))))
+
+
+if __name__ == "__main__":
+  main()
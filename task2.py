@@ -15,7 +15,13 @@
 
 # In[1]:
 
-import pyjokes
+import contextlib
+import functools
+import io
+import re
+import sys
+from array import array
+from collections import deque
 
 class Game:
   """The Game class represents the world.  Internally, we use a 
@@ -26,27 +32,101 @@ class Game:
      location by typing a command like "Go North".
   """
 
-  def __init__(self, start_at):
+  def __init__(self, start_at, directions=None):
+    # The changes that commands have made to the world, for undo and redo.
+    self.history = History()
+    # The directions that this game knows about.  By default this is a copy
+    # of DIRECTIONS, so a game can add its own without changing other games.
+    self.directions = directions or DIRECTIONS.copy()
+    # Dictionary mapping from (location, direction, current location) to
+    # whether that direction out of the location is blocked.  Filled in by
+    # is_blocked() and kept up to date by note_change().
+    self.block_cache = {}
+    # Dictionary mapping from each fact that a cached block status depends on
+    # to the set of block_cache keys that depend on it.  A fact is a
+    # (location, item name) pair, a (game, item name) pair for the inventory,
+    # or a ("visited", location) pair.
+    self.block_dependents = {}
+    # Loads the parts of the world that the player can reach as they move,
+    # for worlds that are loaded lazily from a file, or None.
+    self.loader = None
     # start_at is the location in the game where the player starts
     self.curr_location = start_at
     self.curr_location.has_been_visited = True
     # inventory is the set of objects that the player has collected/
     self.inventory = {}
+    # Index of the special commands of the items in the inventory.
+    self.inventory_commands = CommandIndex()
     # Print the special commands associated with items in the game (helpful 
     # for debugging and for novice players).
     self.print_commands = True
+    # Set to True when the player wins the game.
+    self.won = False
+    # Where the text that the game prints goes.  It is collected while a 
+    # command runs and written out in one go when the command finishes.
+    self.output = BufferedSink()
+    # Records how long each phase of a command takes, or None to not keep
+    # track.  See profiler.py.
+    self.profiler = None
+    # The set that every item and location changed by note_change() is
+    # added to, or None to not keep track.  See template.py.
+    self.touched = None
+    # The shortest paths between locations, for the "go to" command.
+    self.paths = PathIndex(self)
+    # Dictionary mapping from (Location, print_commands) to the location's
+    # version and the text that describes it at that version.
+    self.descriptions = {}
+    # Lists of every Location and Item in the game, where the position in the
+    # list is the object's id.  These are filled in by index_world().
+    self.locations = []
+    self.items = []
+
+  @property
+  def curr_location(self):
+    """The location where the player currently is."""
+    return self._curr_location
+
+  @curr_location.setter
+  def curr_location(self, location):
+    if self.history.step is not None and location is not self._curr_location:
+      self.history.step.append(("move", self._curr_location, location))
+    self._curr_location = location
+    if self.loader:
+      self.loader.enter(location)
 
   def describe(self):
     """Describe the current game state by first describing the current 
        location, then listing any exits, and then describing any objects
-       in the current location."""
-    self.describe_current_location()
-    self.describe_exits()
-    self.describe_items()
+       in the current location.  The text is remembered until the location's
+       version changes, which happens when its items or exits change, so
+       changing a description directly won't show up until then."""
+    profiler = self.profiler
+    if profiler is not None:
+      started = profiler.clock()
+    location = self.curr_location
+    key = (location, self.print_commands)
+    described = self.descriptions.get(key)
+    if described is None or described[0] != location.version:
+      described = self.descriptions[key] = (location.version, self.render_description())
+    self.output.write(described[1])
+    if profiler is not None:
+      profiler.observe("describe", profiler.clock() - started)
+
+  def render_description(self):
+    """Returns the text that describe() prints for the current location."""
+    output = self.output
+    self.output = BufferedSink()
+    try:
+      self.describe_current_location()
+      self.describe_exits()
+      self.describe_items()
+      return "".join(self.output.buffer)
+    finally:
+      self.output = output
 
   def describe_current_location(self):
     """Describe the current location by printing its description field."""
-    print(self.curr_location.description)
+    self.output.print(self.curr_location.description)
 
   def describe_exits(self):
     """List the directions that the player can take to exit from the current
@@ -55,25 +135,205 @@ class Game:
     for exit in self.curr_location.connections.keys():
       exits.append(exit.capitalize())
     if len(exits) > 0:
-      print("Exits: ", end = '')
-      print(*exits, sep = ", ",)
+      self.output.print("Exits: ", end = '')
+      self.output.print(*exits, sep = ", ",)
   
   def describe_items(self):
     """Describe what objects are in the current location."""
     if len(self.curr_location.items) > 0:
-      print("You see: ")
+      self.output.print("You see: ")
       for item_name in self.curr_location.items:
         item = self.curr_location.items[item_name]
-        print(item.description)
+        self.output.print(item.description)
         if self.print_commands:
           special_commands = item.get_commands()
           for cmd in special_commands:
-            print('\t', cmd)
+            self.output.print('\t', cmd)
 
   def add_to_inventory(self, item):
-    """Add an item to the player's inventory."""
-    self.inventory[item.name] = item
+    """Add an item to the player's inventory.  If the item is in a location,
+       it is taken out of there first, since an item is only ever in one
+       place."""
+    old_item = self.inventory.get(item.name)
+    if old_item is not item:
+      holder = item.holder
+      if holder is not None and holder is not self and holder.items.get(item.name) is item:
+        holder.remove_item(item)
+      if old_item:
+        self.inventory_commands.remove(old_item)
+        if old_item.holder is self:
+          old_item.holder = None
+      self.inventory[item.name] = item
+      self.inventory_commands.add(item)
+      self.note_change(("add_to_inventory", item, old_item))
+    item.holder = self
+
+  def remove_from_inventory(self, item):
+    """Remove an item from the player's inventory (for instance, if the player
+       drops it or uses it up)."""
+    removed_item = self.inventory.pop(item.name)
+    self.inventory_commands.remove(removed_item)
+    if removed_item.holder is self:
+      removed_item.holder = None
+    self.note_change(("remove_from_inventory", removed_item))
+    return removed_item
+
+  def visit(self, location):
+    """Mark a location as having been visited by the player."""
+    self.set_visited(location, True)
+
+  def set_visited(self, location, visited):
+    """Mark a location as visited or not visited."""
+    if location.has_been_visited != visited:
+      location.has_been_visited = visited
+      self.note_change(("visit" if visited else "unvisit", location))
+
+  def note_change(self, change):
+    """Called with a tuple describing each change to the items in the world
+       or to the visited locations, so it can be recorded for undo and so the
+       block statuses that depend on it can be forgotten."""
+    if self.history.step is not None:
+      self.history.step.append(change)
+    kind = change[0]
+    if kind == "add_item" or kind == "remove_item":
+      self.forget_fact((change[1], change[2].name))
+      if self.touched is not None:
+        self.touched.add(change[2])
+    elif kind == "add_to_inventory" or kind == "remove_from_inventory":
+      self.forget_fact((self, change[1].name))
+      if self.touched is not None:
+        self.touched.add(change[1])
+    elif kind == "visit" or kind == "unvisit":
+      self.forget_fact(("visited", change[1]))
+      if self.touched is not None:
+        self.touched.add(change[1])
+
+  def is_blocked(self, location, direction):
+    """Returns True if the block in the direction out of the location stops
+       the player.  The result is cached until one of the facts that the
+       block's preconditions depend on changes, or the player moves."""
+    key = (location, direction, self.curr_location)
+    blocked = self.block_cache.get(key)
+    if blocked is None:
+      (block_description, preconditions) = location.blocks[direction]
+      blocked = not test_preconditions(preconditions, self)
+      facts = preconditions.dependencies(self)
+      if facts is None:
+        # The preconditions use a type of check that doesn't say what it
+        # depends on, so its result can't be cached.
+        return blocked
+      self.block_cache[key] = blocked
+      for fact in facts:
+        self.block_dependents.setdefault(fact, set()).add(key)
+    return blocked
+
+  def forget_fact(self, fact):
+    """Forget the cached block statuses that depend on a fact."""
+    keys = self.block_dependents.pop(fact, None)
+    if keys:
+      for key in keys:
+        self.block_cache.pop(key, None)
+    self.paths.forget_fact(fact)
+
+  def forget_blocks(self):
+    """Forget all of the cached block statuses."""
+    self.block_cache.clear()
+    self.block_dependents.clear()
+    self.paths.clear()
+
+  def undo(self):
+    """Undo the changes made by the last command.  Returns False if there is
+       nothing to undo."""
+    if self.history.dry_runs or not self.history.undo_steps:
+      return False
+    step = self.history.undo_steps.pop()
+    for change in reversed(step):
+      self.apply_change(change, undo=True)
+    self.history.redo_steps.append(step)
+    return True
+
+  def redo(self):
+    """Redo the changes of the last command that was undone.  Returns False
+       if there is nothing to redo."""
+    if self.history.dry_runs or not self.history.redo_steps:
+      return False
+    step = self.history.redo_steps.pop()
+    for change in step:
+      self.apply_change(change)
+    self.history.undo_steps.append(step)
+    return True
+
+  def apply_change(self, change, undo=False):
+    """Make a recorded change to the world again, or reverse it."""
+    kind = change[0]
+    if kind == "move":
+      self.curr_location = change[1] if undo else change[2]
+    elif kind == "visit" or kind == "unvisit":
+      self.set_visited(change[1], (kind == "visit") != undo)
+    elif kind == "add_item":
+      kind, location, item, replaced_item = change
+      if not undo:
+        location.add_item(item.name, item)
+      else:
+        location.remove_item(item)
+        if replaced_item:
+          location.add_item(replaced_item.name, replaced_item)
+    elif kind == "remove_item":
+      kind, location, item = change
+      if undo:
+        location.add_item(item.name, item)
+      else:
+        location.remove_item(item)
+    elif kind == "add_to_inventory":
+      kind, item, replaced_item = change
+      if not undo:
+        self.add_to_inventory(item)
+      else:
+        self.remove_from_inventory(item)
+        if replaced_item:
+          self.add_to_inventory(replaced_item)
+    elif kind == "remove_from_inventory":
+      item = change[1]
+      if undo:
+        self.add_to_inventory(item)
+      else:
+        self.remove_from_inventory(item)
   
+  @contextlib.contextmanager
+  def dry_run(self, command_history=None):
+    """Run commands without committing them.  Everything that is done to the
+       world inside a `with game.dry_run() as result:` block is recorded, and
+       undone when the block ends.  The result is a DryRun with the changes
+       that were made, what was printed, and whether the game was won.  The 
+       undo history, output sink and won flag are left as they were, and so
+       is the list of commands the player has entered, if it is given as
+       command_history.  Undo and redo do nothing during a dry run."""
+    result = DryRun()
+    history = self.history
+    saved = (history.step, len(history.undo_steps), len(history.redo_steps),
+             self.output, self.won)
+    if command_history is not None:
+      command_count = len(command_history)
+    history.step = []
+    history.dry_runs += 1
+    self.output = ListSink()
+    try:
+      yield result
+    finally:
+      result.changes = history.step
+      history.step = None
+      for change in reversed(result.changes):
+        self.apply_change(change, undo=True)
+      result.output = self.output.getvalue()
+      result.won = self.won
+      (history.step, undo_count, redo_count, self.output, self.won) = saved
+      history.dry_runs -= 1
+      while len(history.undo_steps) > undo_count:
+        history.undo_steps.pop()
+      del history.redo_steps[redo_count:]
+      if command_history is not None:
+        del command_history[command_count:]
+
   def is_in_inventory(self,item):
     return item.name in self.inventory
 
@@ -86,6 +346,373 @@ class Game:
       items_in_scope.append(self.inventory[item_name])
     return items_in_scope
 
+  def find_special_command(self, command):
+    """Returns an (item, special command) pair for the item in scope whose 
+       special command matches the lowercase command text, or None.  Items in
+       the current location are checked before the inventory."""
+    return (self.curr_location.special_commands.lookup(command) or
+            self.inventory_commands.lookup(command))
+
+  def index_world(self, *things):
+    """Give every location and item in the game an integer id, which is its
+       position in self.locations or self.items.  The world is found by 
+       walking the connections from the current location, and by looking at
+       the items in each location, in the inventory, and in the arguments and
+       preconditions of actions and blocks (which is where items that haven't
+       been created yet are found).  Objects that already have an id keep it,
+       so this can be called again after adding more to the world.  The walk
+       stops at objects that already have ids, so new objects that are added
+       next to them should be given as things to start from."""
+    frontier = list(things) or [self.curr_location] + list(self.inventory.values())
+    while frontier:
+      thing = frontier.pop()
+      if isinstance(thing, Location):
+        if thing.id is not None:
+          continue
+        thing.id = len(self.locations)
+        thing.game = self
+        self.locations.append(thing)
+        frontier.extend(thing.connections.values())
+        frontier.extend(thing.items.values())
+        for block_description, preconditions in thing.blocks.values():
+          frontier.append(preconditions)
+      elif isinstance(thing, Item):
+        if thing.id is not None:
+          continue
+        thing.id = len(self.items)
+        self.items.append(thing)
+        for function, arguments, preconditions in thing.commands.values():
+          frontier.append(arguments)
+          frontier.append(preconditions)
+      elif isinstance(thing, (tuple, list)):
+        frontier.extend(thing)
+      elif isinstance(thing, dict):
+        frontier.extend(thing.values())
+      elif isinstance(thing, Preconditions):
+        frontier.append(thing.source)
+
+  def get_placement(self, item):
+    """Returns a number for where an item is: 0 if it is nowhere, 1 if it is
+       in the inventory, and otherwise 2 plus the id of its location."""
+    if item.holder is None:
+      return 0
+    if item.holder is self:
+      return 1
+    return item.holder.id + 2
+
+  def export_state(self, include_visited=True):
+    """Returns a compact snapshot of everything about the world that changes
+       as the game is played, as a hashable tuple of (current location id,
+       item placements, visited locations).  The placements are packed into
+       bytes with one number from get_placement() per item, and the visited
+       locations are a bitset with one bit per location id, or None if 
+       include_visited is False."""
+    if self.curr_location.id is None:
+      self.index_world()
+    placements = array("I", [self.get_placement(item) for item in self.items])
+    visited = None
+    if include_visited:
+      visited = 0
+      for location in self.locations:
+        if location.has_been_visited:
+          visited |= 1 << location.id
+    return (self.curr_location.id, placements.tobytes(), visited)
+
+  def restore_state(self, state, current=None):
+    """Put the world back into a state returned by export_state().  Only the
+       items whose placement differs from the state are moved.  If the state
+       that the world is in now is given as current, the placements are
+       compared with it instead of asking each item where it is."""
+    location_id, placements, visited = state
+    wanted = array("I")
+    wanted.frombytes(placements)
+    if current is None:
+      moved = [(item, placement) for item, placement in zip(self.items, wanted)
+               if self.get_placement(item) != placement]
+    elif current[1] == placements:
+      moved = []
+    else:
+      have = array("I")
+      have.frombytes(current[1])
+      moved = [(item, placement) for item, had, placement in zip(self.items, have, wanted)
+               if had != placement]
+    self.place_items(moved)
+    self.curr_location = self.locations[location_id]
+    if visited is not None:
+      for location in self.locations:
+        self.set_visited(location, bool(visited >> location.id & 1))
+
+  def place_items(self, moved):
+    """Move items to new places, given as a list of (item, placement) pairs
+       with the placements numbered as by get_placement()."""
+    # Take every moved item out of where it is before putting any of them in
+    # their new places, since different items may share a name.
+    for item, placement in moved:
+      if item.holder is self:
+        self.remove_from_inventory(item)
+      elif item.holder is not None:
+        item.holder.remove_item(item)
+    for item, placement in moved:
+      if placement == 1:
+        self.add_to_inventory(item)
+      elif placement > 1:
+        self.locations[placement - 2].add_item(item.name, item)
+
+class History:
+  """The History records the changes that each command makes to the world, 
+     so that commands can be undone and redone.  Each step is a list of small
+     tuples describing one change each (an item added to or removed from a
+     location or the inventory, the player moving, or a location being 
+     visited), so undoing or redoing a command takes time proportional to 
+     what it changed rather than to the size of the world.
+  """
+  def __init__(self, limit=None):
+    # The steps that can be undone, most recent last.  If there is a limit,
+    # the oldest steps are forgotten.
+    self.undo_steps = deque(maxlen=limit)
+    # The steps that have been undone and can be redone, most recent last.
+    self.redo_steps = []
+    # The list of changes made by the command being run, or None if no 
+    # command is being recorded.
+    self.step = None
+    # The number of dry runs in progress.  Nothing can be undone or redone
+    # during a dry run.
+    self.dry_runs = 0
+
+  def begin_step(self):
+    """Start recording the changes of a new command."""
+    self.step = []
+
+  def end_step(self):
+    """Stop recording, and keep the command's changes if it made any."""
+    if self.step:
+      self.undo_steps.append(self.step)
+      self.redo_steps.clear()
+    self.step = None
+
+
+class DryRun:
+  """What happened during a Game.dry_run(), after it has been undone."""
+  def __init__(self):
+    # The changes that were made to the world, in the same form as a step of
+    # the History.
+    self.changes = []
+    # Everything that was printed.
+    self.output = ""
+    # True if a command ended the game.
+    self.end_game = False
+    # True if the game was won.
+    self.won = False
+    # Whatever the observe function given to Parser.simulate() returned.
+    self.observed = None
+
+class PathIndex:
+  """The shortest paths between locations, along the connections whose 
+     blocks would let the player through.  A block is checked as if the 
+     player were standing in the location that it blocks, with the inventory
+     and the rest of the world as they are now.  The paths from a location 
+     are found with a breadth-first search the first time they are needed,
+     and kept until one of the facts that the blocks on the way depend on 
+     changes (see Game.block_dependents), or the connections change.  Only 
+     the most recently used searches are kept, so that large worlds don't 
+     fill up memory.
+  """
+  def __init__(self, game, limit=256):
+    self.game = game
+    # The most searches to keep.
+    self.limit = limit
+    # Dictionary mapping from each location that has been searched from to
+    # a dictionary that maps every location that can be reached from it to
+    # the (previous location, direction) on the way, or None for itself.
+    self.trees = {}
+    # Dictionary mapping from each fact to the set of locations whose
+    # searches depend on it.
+    self.dependents = {}
+    # Dictionary mapping from lowercase location names to the locations
+    # with that name, and the number of game.locations it was made from.
+    self.names = {}
+    self.names_indexed = 0
+
+  def clear(self):
+    """Forget all of the searches."""
+    self.trees.clear()
+    self.dependents.clear()
+
+  def forget_fact(self, fact):
+    """Forget the searches that depend on a fact."""
+    sources = self.dependents.pop(fact, None)
+    if sources:
+      for source in sources:
+        self.trees.pop(source, None)
+
+  def precompute(self):
+    """Search from every location, which gives the shortest paths between 
+       all pairs of locations.  This is only worth it for small worlds."""
+    self.limit = max(self.limit, len(self.game.locations))
+    for location in self.game.locations:
+      self.paths_from(location)
+
+  def find(self, name):
+    """Returns the location with the given name, ignoring case, or None."""
+    locations = self.game.locations
+    if self.names_indexed != len(locations):
+      for location in locations[self.names_indexed:]:
+        self.names.setdefault(" ".join(location.name.lower().split()), []).append(location)
+      self.names_indexed = len(locations)
+    matches = self.names.get(" ".join(name.lower().split()))
+    return matches[0] if matches else None
+
+  def path(self, source, destination):
+    """Returns the list of directions of the shortest path between two
+       locations, or None if there isn't one."""
+    tree = self.paths_from(source)
+    if destination not in tree:
+      return None
+    directions = []
+    while tree[destination] is not None:
+      destination, direction = tree[destination]
+      directions.append(direction)
+    directions.reverse()
+    return directions
+
+  def paths_from(self, source):
+    tree = self.trees.get(source)
+    if tree is not None:
+      return tree
+    tree, facts = self.search(source)
+    if facts is not None:
+      if len(self.trees) >= self.limit:
+        self.trees.pop(next(iter(self.trees)))
+      self.trees[source] = tree
+      for fact in facts:
+        self.dependents.setdefault(fact, set()).add(source)
+    return tree
+
+  def search(self, source):
+    """Do a breadth-first search from the source.  Returns the tree of paths
+       and a list of the facts that it depends on, or None if some of the 
+       blocks on the way don't say what they depend on.  Paths don't go on
+       through locations that end the game."""
+    game = self.game
+    tree = {source: None}
+    facts = []
+    frontier = deque([source])
+    # Blocks are checked with the player put in each location in turn, 
+    # without going through curr_location, so the moves aren't recorded.
+    player_location = game._curr_location
+    try:
+      while frontier:
+        location = frontier.popleft()
+        game._curr_location = location
+        for direction, next_location in location.connections.items():
+          if next_location in tree:
+            continue
+          if direction in location.blocks:
+            if facts is not None:
+              block_facts = location.blocks[direction][1].dependencies(game)
+              if block_facts is None:
+                facts = None
+              else:
+                facts.extend(block_facts)
+            if game.is_blocked(location, direction):
+              continue
+          tree[next_location] = (location, direction)
+          if not next_location.end_game:
+            frontier.append(next_location)
+    finally:
+      game._curr_location = player_location
+    return tree, facts
+
+
+# ## Output
+# Rather than calling `print()`, the game sends everything it prints to an output sink, `game.output`, which has a `print()` method that takes the same arguments.  The parser flushes the sink when each command has finished, so a sink can write all of a command's output at once.  The default sink writes to the console, but a game can be given a sink that throws the output away (for searching and benchmarks), keeps it in a list (for tests), or sends it over a network connection.
+
+# In[ ]:
+
+
+class OutputSink:
+  """The base class of output sinks.  Subclasses override write(), which is
+     given the text of each call to print(), and flush()."""
+  def print(self, *values, sep=" ", end="\n"):
+    """Print the values, like the built-in print() function."""
+    self.write(sep.join(str(value) for value in values) + end)
+
+  def write(self, text):
+    raise NotImplementedError
+
+  def flush(self):
+    pass
+
+class BufferedSink(OutputSink):
+  """Collects the output of a command and writes it to a file when flushed."""
+  def __init__(self, file=None):
+    # The file to write to, or None to write to whatever sys.stdout is when
+    # the output is flushed.
+    self.file = file
+    # The text printed since the last flush.
+    self.buffer = []
+
+  def write(self, text):
+    self.buffer.append(text)
+
+  def flush(self):
+    if self.buffer:
+      text = "".join(self.buffer)
+      self.buffer.clear()
+      file = self.file or sys.stdout
+      file.write(text)
+      file.flush()
+
+class NullSink(OutputSink):
+  """Throws the output away."""
+  def print(self, *values, sep=" ", end="\n"):
+    pass
+
+  def write(self, text):
+    pass
+
+class ListSink(OutputSink):
+  """Keeps the output in a list, with one string for each command."""
+  def __init__(self):
+    # The output of each command that has finished.
+    self.outputs = []
+    # The text printed since the last flush.
+    self.buffer = []
+
+  def write(self, text):
+    self.buffer.append(text)
+
+  def flush(self):
+    if self.buffer:
+      self.outputs.append("".join(self.buffer))
+      self.buffer.clear()
+
+  def getvalue(self):
+    """Returns everything that has been printed."""
+    return "".join(self.outputs) + "".join(self.buffer)
+
+class AsyncSink(OutputSink):
+  """Sends the output of each command to an asyncio StreamWriter in a single
+     write.  Whoever runs the command should await the writer's drain()."""
+  def __init__(self, writer, encoding="utf-8"):
+    # The stream to send the output to.
+    self.writer = writer
+    self.encoding = encoding
+    # The text printed since the last flush.
+    self.buffer = []
+    # True while whoever runs the command has more to add to its output, so
+    # flushing waits until this is False again.
+    self.held = False
+
+  def write(self, text):
+    self.buffer.append(text)
+
+  def flush(self):
+    if self.buffer and not self.held:
+      text = "".join(self.buffer)
+      self.buffer.clear()
+      self.writer.write(text.encode(self.encoding))
+
 
 # ## Locations
 # 
@@ -103,78 +730,146 @@ class Location:
      whose values are the location that is the result of traveling in that 
      direction.  The travel_descriptions also has directions as keys, and its 
      values are an optional short desciption of traveling to that location.
+     Locations use __slots__ rather than a dictionary of attributes, since a
+     large world has a great many of them.
   """
+  __slots__ = ("name", "description", "end_game", "connections",
+               "travel_descriptions", "items", "special_commands", "blocks",
+               "has_been_visited", "id", "game", "version", "exit_names")
+
   def __init__(self, name, description, end_game=False):
     # A short name for the location
-    self.name = name
+    self.name = sys.intern(name)
     # A description of the location
     self.description = description
     # True if entering this location should end the game
     self.end_game = end_game
     # Dictionary mapping from directions to other Location objects
     self.connections = {}
-    # Dictionary mapping from directions to text description of the path there
+    # Dictionary mapping from directions to text description of the path 
+    # there, for the directions that have one
     self.travel_descriptions = {}
     # Dictionary mapping from item name to Item objects present in this location
     self.items = {}
+    # Index of the special commands of the items present in this location
+    self.special_commands = CommandIndex()
     # Dictionary mapping from direction to Block object in that direction
     self.blocks = {}
     # Flag that gets set to True once this location has been visited by player
     self.has_been_visited = False
+    # The id of this location in the Game, set by Game.index_world()
+    self.id = None
+    # The Game this location belongs to, set by Game.index_world()
+    self.game = None
+    # A number that goes up whenever the items, connections or blocks of 
+    # this location change, so that things worked out from them can tell 
+    # when they are out of date.
+    self.version = 0
+    # The version of the location and a dictionary mapping from the
+    # lowercase name of each exit to its direction, made by find_exit(), or
+    # None.
+    self.exit_names = None
+
+  @property
+  def directions(self):
+    """The registry of directions that this location's connections use: its
+       game's, or DIRECTIONS if it doesn't belong to a game yet."""
+    return self.game.directions if self.game else DIRECTIONS
+
+  def find_exit(self, name):
+    """Returns the direction of the exit out of this location whose name,
+       ignoring case, is the given lowercase text, or None."""
+    if name in self.connections:
+      return name
+    exit_names = self.exit_names
+    if exit_names is None or exit_names[0] != self.version:
+      exit_names = self.exit_names = (self.version, {direction.lower(): direction
+                                                     for direction in self.connections})
+    return exit_names[1].get(name)
 
   def add_connection(self, direction, connected_location, travel_description=""):
     """Add a connection from the current location to a connected location.
        Direction is a string that the player can use to get to the connected
-       location.  If the direction is a cardinal direction, then we also 
-       automatically make a connection in the reverse direction."""
+       location, or an alias of one like "n".  If the direction has an 
+       opposite in the location's directions, then we also automatically make
+       a connection in the reverse direction, unless the connected location
+       already has an exit that way."""
+    directions = self.directions
+    direction = directions.canonical(direction)
     self.connections[direction] = connected_location
-    self.travel_descriptions[direction] = travel_description
-    if direction == 'north':
-      connected_location.connections["south"] = self
-      connected_location.travel_descriptions["south"] = ""
-    if direction == 'south':
-      connected_location.connections["north"] = self
-      connected_location.travel_descriptions["north"] = ""
-    if direction == 'east':
-      connected_location.connections["west"] = self
-      connected_location.travel_descriptions["west"] = ""
-    if direction == 'west':
-      connected_location.connections["east"] = self
-      connected_location.travel_descriptions["east"] = ""
-    if direction == 'up':
-      connected_location.connections["down"] = self
-      connected_location.travel_descriptions["down"] = ""
-    if direction == 'down':
-      connected_location.connections["up"] = self
-      connected_location.travel_descriptions["up"] = ""
-    if direction == 'in':
-      connected_location.connections["out"] = self
-      connected_location.travel_descriptions["out"] = ""
-    if direction == 'out':
-      connected_location.connections["in"] = self
-      connected_location.travel_descriptions["in"] = ""
-
+    if travel_description:
+      self.travel_descriptions[direction] = travel_description
+    else:
+      self.travel_descriptions.pop(direction, None)
+    self.version += 1
+    opposite = directions.opposites.get(direction)
+    if opposite and opposite not in connected_location.connections:
+      connected_location.connections[opposite] = self
+      connected_location.version += 1
+    if self.game:
+      self.game.paths.clear()
 
   def add_item(self, name, item):
     """Put an item in this location."""
-    self.items[name] = item
+    old_item = self.items.get(name)
+    if old_item is not item:
+      if old_item:
+        self.special_commands.remove(old_item)
+        if old_item.holder is self:
+          old_item.holder = None
+      self.items[name] = item
+      self.special_commands.add(item)
+      self.version += 1
+      if self.game:
+        self.game.note_change(("add_item", self, item, old_item))
+    item.holder = self
 
   def remove_item(self, item):
     """Remove an item from this location (for instance, if the player picks it
        up and puts it in their inventory)."""
-    self.items.pop(item.name)
-
-
-  def is_blocked(self, direction, game):
-    """Check to if there is an obstacle in this direction."""
+    removed_item = self.items.pop(item.name)
+    self.special_commands.remove(removed_item)
+    if removed_item.holder is self:
+      removed_item.holder = None
+    self.version += 1
+    if self.game:
+      self.game.note_change(("remove_item", self, removed_item))
+
+  def order_items(self, items):
+    """Put the items in this location into the given order, which is the
+       order they are listed in and the order that breaks ties when they
+       are looked up by name or command.  Items that are here but aren't
+       given go after the given ones, in the order they were in."""
+    current = list(self.items.values())
+    ordered = [item for item in items if self.items.get(item.name) is item]
+    given = set(ordered)
+    ordered.extend(item for item in current if item not in given)
+    if all(item is old_item for item, old_item in zip(ordered, current)):
+      return
+    self.items = {item.name: item for item in ordered}
+    self.special_commands = CommandIndex()
+    for item in ordered:
+      self.special_commands.add(item)
+    self.version += 1
+
+  def is_blocked(self, direction, game, print_failure_reasons=True):
+    """Check to if there is an obstacle in this direction.  Once the world
+       has been indexed, the answer comes from the game's block cache."""
     if not direction in self.blocks:
         return False
     (block_description, preconditions) = self.blocks[direction]
-    if check_preconditions(preconditions, game):
+    if self.game is game:
+      blocked = game.is_blocked(self, direction)
+    else:
+      blocked = not test_preconditions(preconditions, game)
+    if not blocked:
       # All the preconditions have been met.  You may pass.
       return False
     else: 
       # There are still obstalces to overcome or puzzles to solve.
+      if print_failure_reasons:
+        for reason in preconditions.failure_reasons(game):
+          game.output.print(reason)
       return True
 
   def get_block_description(self, direction):
@@ -188,49 +883,479 @@ class Location:
   def add_block(self, blocked_direction, block_description, preconditions):
     """Create an obstacle that prevents a player from moving in the blocked 
        location until the preconditions are all met."""
-    self.blocks[blocked_direction] = (block_description, preconditions)
+    self.blocks[self.directions.canonical(blocked_direction)] = (block_description, compile_preconditions(preconditions))
+    self.version += 1
+    if self.game:
+      self.game.forget_blocks()
+
+def add_connections(connections, directions=None):
+  """Add many connections at once, given (location, direction, connected
+     location) triples.  This does the same as calling add_connection() for
+     each of them, in a single pass over the connections, with the given
+     registry of directions or DIRECTIONS."""
+  directions = directions or DIRECTIONS
+  aliases = directions.aliases
+  opposites = directions.opposites
+  intern = sys.intern
+  for location, direction, connected_location in connections:
+    direction = intern(aliases.get(direction, direction))
+    location.connections[direction] = connected_location
+    location.travel_descriptions.pop(direction, None)
+    location.version += 1
+    opposite = opposites.get(direction)
+    if opposite and opposite not in connected_location.connections:
+      connected_location.connections[opposite] = location
+      connected_location.version += 1
+    if location.game:
+      location.game.paths.clear()
+
+class Directions:
+  """The registry of the directions that locations can be connected in.  A
+     direction can have an opposite, which add_connection() uses to connect
+     locations both ways, and aliases such as "n" for north.  The parser 
+     looks up directions here too.  A direction (or one of its aliases) is
+     recognized when it is the whole command, compass directions are also
+     recognized anywhere in a command, and directions like "in" and "out" 
+     are recognized after "go".  Each Game has its own copy of DIRECTIONS,
+     which it can add its own directions to.
+  """
+  def __init__(self):
+    # Dictionary mapping from each direction to its opposite.
+    self.opposites = {}
+    # Dictionary mapping from each alias to the direction it stands for.
+    self.aliases = {}
+    # Dictionary mapping from single-word commands to the direction they name.
+    self.commands = {}
+    # Dictionary mapping from words that name a direction anywhere in a 
+    # command to the direction.
+    self.words = {}
+    # Dictionary mapping from words that name a direction after "go" to the
+    # direction.
+    self.go_words = {}
+
+  def add(self, direction, opposite=None, aliases=(), anywhere=False,
+          alone=True, after_go=False):
+    """Add a direction to the registry.  If alone is True the direction is
+       a command by itself, if anywhere is True it is recognized anywhere in
+       a command, and if after_go is True it is recognized after "go".  The
+       aliases are always commands by themselves."""
+    direction = sys.intern(direction)
+    if opposite:
+      self.opposites[direction] = sys.intern(opposite)
+    for alias in aliases:
+      self.aliases[alias] = direction
+      self.commands[alias] = direction
+    if alone:
+      self.commands[direction] = direction
+    if anywhere:
+      self.words[direction] = direction
+    if after_go:
+      self.go_words[direction] = direction
+
+  def canonical(self, direction):
+    """Returns the direction that a direction or alias stands for."""
+    return sys.intern(self.aliases.get(direction, direction))
+
+  def copy(self):
+    """Returns a new registry with the same directions, which can be added
+       to without changing this one."""
+    directions = Directions()
+    directions.opposites = dict(self.opposites)
+    directions.aliases = dict(self.aliases)
+    directions.commands = dict(self.commands)
+    directions.words = dict(self.words)
+    directions.go_words = dict(self.go_words)
+    return directions
+
+# The directions that every game knows about, which each Game copies.
+DIRECTIONS = Directions()
+DIRECTIONS.add("north", "south", ["n"], anywhere=True)
+DIRECTIONS.add("south", "north", ["s"], anywhere=True)
+DIRECTIONS.add("east", "west", ["e"], anywhere=True)
+DIRECTIONS.add("west", "east", ["w"], anywhere=True)
+DIRECTIONS.add("northeast", "southwest", ["ne"], anywhere=True)
+DIRECTIONS.add("northwest", "southeast", ["nw"], anywhere=True)
+DIRECTIONS.add("southeast", "northwest", ["se"], anywhere=True)
+DIRECTIONS.add("southwest", "northeast", ["sw"], anywhere=True)
+DIRECTIONS.add("up", "down")
+DIRECTIONS.add("down", "up")
+DIRECTIONS.add("in", "out", alone=False, after_go=True)
+DIRECTIONS.add("out", "in", alone=False, after_go=True)
 
 
 # ## Checking Preconditions 
 # In text adventure games it's common to block a player's progress by creating blocks that prevent them from moving to a location.  For instance, a drawbridge might have a troll that you need to get rig of before you can cross into the castle, or a locked door might prevent you from entering a building until you have a key.  
 # 
-# This is a function that you can modify to include other preconditions.
+# Preconditions are written as a dictionary, and compiled by the Preconditions class when a block or action is added.  You can add other types of preconditions by adding a function to `CONDITION_TYPES`.  Besides checking the inventory and the player's location, the types include `item_in_location` (an item and a location), `visited` (a location), and `not` and `any_of`, which combine other preconditions.
 
 # In[3]:
 
 
+class Preconditions:
+  """Preconditions are compiled once, when a block or an action is added, 
+     from a dictionary like {"inventory_contains": key, "in_location": tower}.
+     Each entry becomes a test function that takes the game, and all of the
+     tests are combined into a single predicate, so checking them doesn't 
+     involve looking at the dictionary again.  The messages that explain why
+     a precondition failed are kept separately and only worked out when they
+     are needed.  Preconditions can be nested with "not" and "any_of".
+  """
+  __slots__ = ("source", "checks", "test")
+
+  def __init__(self, preconditions):
+    # The dictionary that these preconditions were compiled from.
+    self.source = preconditions
+    # List of (test, message, dependencies) triples, one for each entry in
+    # the dictionary.  The message is a function that explains the failure,
+    # or None.  The dependencies are a function that lists the facts that the
+    # test depends on, or None if they aren't known.
+    self.checks = [compile_condition(check, value)
+                   for check, value in preconditions.items()]
+    tests = tuple(test for test, message, dependencies in self.checks)
+    if not tests:
+      self.test = no_preconditions
+    elif len(tests) == 1:
+      self.test = tests[0]
+    else:
+      self.test = lambda game: all(test(game) for test in tests)
+
+  def failure_reasons(self, game):
+    """Returns a list of messages explaining which preconditions aren't met."""
+    reasons = []
+    for test, message, dependencies in self.checks:
+      if message and not test(game):
+        reasons.extend(message(game))
+    return reasons
+
+  def dependencies(self, game):
+    """Returns a list of the facts that test() depends on besides the 
+       player's location (see Game.block_dependents), or None if some of the
+       checks don't say what they depend on."""
+    facts = []
+    for test, message, dependencies in self.checks:
+      check_facts = dependencies(game) if dependencies else None
+      if check_facts is None:
+        return None
+      facts.extend(check_facts)
+    return facts
+
+def no_preconditions(game):
+  return True
+
+def compile_preconditions(preconditions):
+  """Returns compiled Preconditions for a dictionary of preconditions.  The
+     many actions and blocks that have no preconditions share one object."""
+  if isinstance(preconditions, Preconditions):
+    return preconditions
+  if not preconditions:
+    return NO_PRECONDITIONS
+  return Preconditions(preconditions)
+
+def compile_condition(check, value):
+  """Compile one entry of a preconditions dictionary into a (test, message,
+     dependencies) triple.  Appending "_silent" to any type of check means 
+     that no message is given when it fails.  Types of checks that only give
+     a (test, message) pair are never cached."""
+  silent = check.endswith("_silent")
+  if silent:
+    check = check[:-len("_silent")]
+  if not check in CONDITION_TYPES:
+    raise ValueError("Unknown type of precondition: %s" % check)
+  compiled = CONDITION_TYPES[check](value)
+  test, message = compiled[:2]
+  dependencies = compiled[2] if len(compiled) > 2 else None
+  return test, (None if silent else message), dependencies
+
+def inventory_contains(item):
+  return (lambda game: game.inventory.get(item.name) is item,
+          lambda game: ["You don't have the %s" % item.name],
+          lambda game: [(game, item.name)])
+
+def in_location(location):
+  return (lambda game: game.curr_location is location,
+          lambda game: ["You aren't in the correct location"],
+          lambda game: [])
+
+def location_has_item(item):
+  return (lambda game: game.curr_location.items.get(item.name) is item,
+          lambda game: ["The %s isn't in this location" % item.name],
+          lambda game: [(game.curr_location, item.name)])
+
+def item_in_location(item_and_location):
+  item, location = item_and_location
+  return (lambda game: location.items.get(item.name) is item,
+          lambda game: ["The %s isn't in the %s" % (item.name, location.name)],
+          lambda game: [(location, item.name)])
+
+def has_visited(location):
+  return (lambda game: location.has_been_visited,
+          lambda game: ["You haven't been to the %s yet" % location.name],
+          lambda game: [("visited", location)])
+
+def not_condition(preconditions):
+  preconditions = Preconditions(preconditions)
+  return (lambda game: not preconditions.test(game), None,
+          preconditions.dependencies)
+
+def any_of_conditions(alternatives):
+  alternatives = [Preconditions(preconditions) for preconditions in alternatives]
+  tests = tuple(preconditions.test for preconditions in alternatives)
+  def dependencies(game):
+    facts = []
+    for preconditions in alternatives:
+      alternative_facts = preconditions.dependencies(game)
+      if alternative_facts is None:
+        return None
+      facts.extend(alternative_facts)
+    return facts
+  return (lambda game: any(test(game) for test in tests),
+          lambda game: alternatives[0].failure_reasons(game),
+          dependencies)
+
+# Dictionary mapping from the type of a precondition to a function that
+# compiles its value into a (test, message, dependencies) triple.  The
+# dependencies function lists the facts that the test depends on.
+CONDITION_TYPES = {
+  "inventory_contains": inventory_contains,
+  "in_location": in_location,
+  "location_has_item": location_has_item,
+  "item_in_location": item_in_location,
+  "visited": has_visited,
+  "not": not_condition,
+  "any_of": any_of_conditions,
+}
+
+# The compiled Preconditions shared by everything that has none.
+NO_PRECONDITIONS = Preconditions({})
+
+def test_preconditions(preconditions, game):
+  """Tests compiled Preconditions.  If the game has a profiler, the time the
+     test takes is recorded, and whether it failed.  Actions and blocks both
+     test their preconditions here."""
+  profiler = game.profiler
+  if profiler is None:
+    return preconditions.test(game)
+  started = profiler.clock()
+  met = preconditions.test(game)
+  profiler.observe("preconditions", profiler.clock() - started)
+  if not met:
+    profiler.count("preconditions_failed")
+  return met
+
 def check_preconditions(preconditions, game, print_failure_reasons=True):
   """Checks whether the player has met all of the specified preconditions"""
-  all_conditions_met = True
-  for check in preconditions: 
-    if check == "inventory_contains":
-      item = preconditions[check]
-      if not game.is_in_inventory(item):
-        all_conditions_met = False
-        if print_failure_reasons:
-          print("You don't have the %s" % item.name)
-    if check == "inventory_contains_silent":
-      item = preconditions[check]
-      if not game.is_in_inventory(item):
-        all_conditions_met = False
-    if check == "in_location":
-      location = preconditions[check]
-      if not game.curr_location == location:
-        all_conditions_met = False
-        if print_failure_reasons:
-          print("You aren't in the correct location")
-    if check == "location_has_item":
-      item = preconditions[check]
-      if not item.name in game.curr_location.items:
-        all_conditions_met = False
-        if print_failure_reasons:
-          print("The %s isn't in this location" % item.name)
-    if check == "location_has_item_silent":
-      item = preconditions[check]
-      if not item.name in game.curr_location.items:
-        all_conditions_met = False
-    # todo - add other types of preconditions
-  return all_conditions_met
+  if not isinstance(preconditions, Preconditions):
+    preconditions = Preconditions(preconditions)
+  met = test_preconditions(preconditions, game)
+  if not met and print_failure_reasons:
+    for reason in preconditions.failure_reasons(game):
+      game.output.print(reason)
+  return met
+
+# Punctuation that is ignored at the start and end of a word.
+WORD_PUNCTUATION = ".,;:!?\"'()"
+PUNCTUATION_PATTERN = re.compile("[%s]" % re.escape(WORD_PUNCTUATION))
+
+def name_words(text):
+  """Returns the lowercase words of a name or command, without the
+     punctuation around them."""
+  words = text.lower().split()
+  if PUNCTUATION_PATTERN.search(text) is None:
+    return words
+  return [word for word in (word.strip(WORD_PUNCTUATION) for word in words) if word]
+
+@functools.lru_cache(maxsize=4096)
+def word_variants(word):
+  """Returns the word along with each of the ways of deleting one letter
+     from it.  Two words are at most one edit apart only if they have a
+     variant in common.  The variants of each word are only worked out
+     once."""
+  variants = {word}
+  for i in range(len(word)):
+    variants.add(word[:i] + word[i + 1:])
+  return frozenset(variants)
+
+def within_one_edit(word, other):
+  """Returns True if one letter can be inserted, deleted or changed in the
+     word to make the other word, or they are the same."""
+  if word == other:
+    return True
+  if abs(len(word) - len(other)) > 1:
+    return False
+  if len(word) > len(other):
+    word, other = other, word
+  i = 0
+  while i < len(word) and word[i] == other[i]:
+    i += 1
+  if len(word) == len(other):
+    return word[i + 1:] == other[i + 1:]
+  return word[i:] == other[i + 1:]
+
+class CommandIndex:
+  """A CommandIndex maps the lowercase text of special commands to the items 
+     that respond to them, and the words of item names to the items that have
+     them.  Each location keeps one for the items that are in it, and the game
+     keeps one for the inventory, so that the parser can find a special
+     command or an item without looking at every item in scope.  The index is
+     updated whenever an item is added or removed, and whenever an item that
+     is already indexed gets a new action or alias.
+  """
+  __slots__ = ("commands", "names", "fuzzy")
+
+  # Words shorter than this have to be typed exactly.
+  FUZZY_LENGTH = 4
+
+  def __init__(self):
+    # Dictionary mapping from command text to the (Item, special command)
+    # pair of the item that responds to it.  When several items respond to
+    # the same command, the value is a dictionary of item name to pairs.
+    self.commands = {}
+    # Dictionary mapping from the first word of each name to a list of
+    # (words of the name, Item) pairs, with the longest names first and
+    # otherwise in the order they were added.
+    self.names = {}
+    # Dictionary mapping from each variant of the first word of a name
+    # (see word_variants) to the list of first words that have it, for the
+    # first words that are long enough to be matched when misspelled.  It
+    # is only built when a misspelling is looked up, and is None when the
+    # first words have changed since then.
+    self.fuzzy = None
+
+  def add(self, item):
+    """Add all of an item's special commands and names to the index."""
+    if self in item.command_indexes:
+      return
+    for command, special_command in item.command_lookup.items():
+      self.add_command(item, command, special_command)
+    names = self.names
+    for words in item.name_keys:
+      if words[0] in names:
+        self.add_name(item, words)
+      else:
+        names[words[0]] = [(words, item)]
+        self.fuzzy = None
+    item.command_indexes.append(self)
+
+  def add_name(self, item, words):
+    """Add one of an item's names to the index, given its words."""
+    first = words[0]
+    entries = self.names.get(first)
+    if entries is None:
+      self.names[first] = [(words, item)]
+      self.fuzzy = None
+      return
+    position = len(entries)
+    while position and len(entries[position - 1][0]) < len(words):
+      position -= 1
+    entries.insert(position, (words, item))
+
+  def add_command(self, item, command, special_command):
+    """Add a single special command of an item to the index."""
+    entry = (item, special_command)
+    entries = self.commands.get(command)
+    if entries is None or (type(entries) is tuple and entries[0].name == item.name):
+      self.commands[command] = entry
+    else:
+      if type(entries) is tuple:
+        entries = self.commands[command] = {entries[0].name: entries}
+      entries[item.name] = entry
+
+  def remove(self, item):
+    """Remove all of an item's special commands and names from the index."""
+    if not self in item.command_indexes:
+      return
+    for command in item.command_lookup:
+      entries = self.commands.get(command)
+      if type(entries) is tuple:
+        if entries[0] is item:
+          del self.commands[command]
+      elif entries and entries.get(item.name, (None,))[0] is item:
+        del entries[item.name]
+        if not entries:
+          del self.commands[command]
+    names = self.names
+    for words in item.name_keys:
+      first = words[0]
+      entries = names.get(first)
+      if not entries:
+        continue
+      if len(entries) > 1:
+        entries[:] = [entry for entry in entries if entry[1] is not item]
+        if entries:
+          continue
+      elif entries[0][1] is not item:
+        continue
+      del names[first]
+      self.fuzzy = None
+    item.command_indexes.remove(self)
+
+  def lookup(self, command):
+    """Returns the (item, special command) pair for the command text, or None
+       if no indexed item responds to it."""
+    entries = self.commands.get(command)
+    if type(entries) is tuple:
+      return entries
+    if entries:
+      return next(iter(entries.values()))
+    return None
+
+  def match_name(self, words, best=None):
+    """Find the longest item name that appears in the list of words.  Returns
+       a tuple of (number of words, position, item), or None.  Among names of
+       the same length the one nearest the start of the words wins, and then
+       the one that was indexed first.  If the best match so far is given,
+       from another index, it is returned unless there is a better one."""
+    names = self.names
+    for position, word in enumerate(words):
+      entries = names.get(word)
+      if entries is None:
+        continue
+      for name, item in entries:
+        size = len(name)
+        if best and (size < best[0] or size == best[0] and position >= best[1]):
+          break
+        if size == 1 or words[position:position + size] == name:
+          best = (size, position, item)
+          break
+    return best
+
+  def match_fuzzy(self, words, best=None):
+    """Like match_name, but each word of a name that is long enough may be
+       misspelled by one letter."""
+    for position, word in enumerate(words):
+      if len(word) < self.FUZZY_LENGTH:
+        continue
+      if self.fuzzy is None:
+        self.fuzzy = {}
+        for first in self.names:
+          if len(first) >= self.FUZZY_LENGTH:
+            for variant in word_variants(first):
+              self.fuzzy.setdefault(variant, []).append(first)
+      firsts = set()
+      for variant in word_variants(word):
+        firsts.update(self.fuzzy.get(variant, ()))
+      for first in sorted(firsts):
+        if not within_one_edit(word, first):
+          continue
+        for name, item in self.names[first]:
+          size = len(name)
+          if best and (size < best[0] or size == best[0] and position >= best[1]):
+            break
+          if self.words_match(name, words[position:position + size]):
+            best = (size, position, item)
+            break
+    return best
+
+  def words_match(self, name, words):
+    """Returns True if the words are the words of the name, allowing for a
+       misspelling in each of the longer ones."""
+    if len(words) != len(name):
+      return False
+    for word, expected in zip(words, name):
+      if word != expected and (len(expected) < self.FUZZY_LENGTH or
+                               not within_one_edit(word, expected)):
+        return False
+    return True
 
 
 # ## Items
@@ -242,6 +1367,10 @@ def check_preconditions(preconditions, game, print_failure_reasons=True):
 class Item:
   """Items are objects that a player can get, or scenery that a player can
      examine."""
+  __slots__ = ("name", "description", "examine_text", "take_text", "gettable",
+               "end_game", "commands", "command_lookup", "command_indexes",
+               "holder", "id", "aliases", "name_keys")
+
   def __init__(self,
                name,
                description,
@@ -249,9 +1378,19 @@ class Item:
                take_text="",
                start_at=None,
                gettable=True,
-               end_game=False):
+               end_game=False,
+               aliases=()):
     # The name of the object
-    self.name = name
+    self.name = sys.intern(name)
+    # Other names that the player can use for the object.
+    self.aliases = list(aliases)
+    # The words of the name and of each alias, which they are indexed by.
+    words = name_words(name)
+    self.name_keys = [words] if words else []
+    for alias in self.aliases:
+      words = name_words(alias)
+      if words:
+        self.name_keys.append(words)
     # The default description of the object.
     self.description = description
     # The detailed description of the player examines the object.
@@ -262,19 +1401,55 @@ class Item:
     self.gettable = gettable
     # True if entering this location should end the game.
     self.end_game = end_game
+    self.commands = {}
+    # Dictionary mapping from lowercase command text to the special command.
+    self.command_lookup = {}
+    # The command indexes of the location or inventory that hold this item.
+    self.command_indexes = []
+    # The Location this item is in, the Game if it is in the player's
+    # inventory, or None if it isn't anywhere.
+    self.holder = None
+    # The id of this item in the Game, set by Game.index_world()
+    self.id = None
     # The location in the Game where the object starts.
     if start_at:
       start_at.add_item(name, self)
-    self.commands = {}
 
 
   def get_commands(self):
     """Returns a list of special commands associated with this object"""
     return self.commands.keys()
 
+  def get_names(self):
+    """Returns a list of the names that the player can use for this object"""
+    return [self.name] + self.aliases
+
+  def add_alias(self, alias):
+    """Add another name that the player can use for this object"""
+    if alias in self.get_names():
+      return
+    self.aliases.append(alias)
+    words = name_words(alias)
+    if words:
+      self.name_keys.append(words)
+      for index in self.command_indexes:
+        index.add_name(self, words)
+
+  def get_command(self, command):
+    """Returns the special command that matches the lowercase command text, or
+       None if this item doesn't have one."""
+    return self.command_lookup.get(command)
+
   def add_action(self, command_text, function, arguments, preconditions={}):
     """Add a special action associated with this item"""
-    self.commands[command_text] = (function, arguments, preconditions)
+    command_text = sys.intern(command_text)
+    self.commands[command_text] = (function, arguments, compile_preconditions(preconditions))
+    command = sys.intern(" ".join(command_text.lower().split()))
+    self.command_lookup[command] = command_text
+    for index in self.command_indexes:
+      index.add_command(self, command, command_text)
+    if isinstance(self.holder, Location):
+      self.holder.version += 1
 
   def do_action(self, command_text, game):
     """Perform a special action associated with this item"""
@@ -282,9 +1457,15 @@ class Item:
     if command_text in self.commands:
       function, arguments, preconditions = self.commands[command_text]
       if check_preconditions(preconditions, game):
-        end_game = function(game, arguments)
+        profiler = game.profiler
+        if profiler is None:
+          end_game = function(game, arguments)
+        else:
+          started = profiler.clock()
+          end_game = function(game, arguments)
+          profiler.observe("action", profiler.clock() - started)
     else:
-      print("Cannot perform the action %s" % command_text)
+      game.output.print("Cannot perform the action %s" % command_text)
     return end_game
 
     
@@ -302,37 +1483,72 @@ class Parser:
      in order to interpret what the player intended, and how that intent
      is reflected in the simulated world. 
   """
+  # Commands that are recognized by their exact text.
+  EXACT_INTENTS = {"look": "redescribe", "l": "redescribe", "i": "inventory",
+                   "undo": "undo", "redo": "redo"}
+  # Words that signal an intent wherever they appear in the command.
+  VERB_INTENTS = {"examine": "examine", "take": "take", "get": "take",
+                  "drop": "drop", "inventory": "inventory"}
+  # Verbs that only count when they are the first word of the command.
+  LEADING_VERB_INTENTS = {"x": "examine"}
+  # Which scopes each intent searches for the item it acts on.
+  ITEM_SCOPES = {"examine": (True, True), "take": (True, True),
+                 "drop": (False, True)}
+
   def __init__(self, game):
     # A list of all of the commands that the player has issued.
     self.command_history = []
     # A pointer to the game.
     self.game = game
+    # Give the world ids so that the changes commands make can be recorded.
+    self.game.index_world()
 
   def get_player_intent(self,command):
+    profiler = self.game.profiler
+    if profiler is None:
+      return self.route_command(command)[0]
+    started = profiler.clock()
+    intent = self.route_command(command)[0]
+    profiler.observe("intent", profiler.clock() - started)
+    return intent
+
+  def route_command(self, command):
+    """Tokenize the command once and work out what the player intends.  
+       Returns a tuple of (intent, direction, item, action), where direction,
+       item and action are whatever the intent needs in order to run."""
     command = command.lower()
     if "," in command:
       # Let the player type in a comma separted sequence of commands
-      return "sequence"
-    elif self.get_direction(command):
-      # Check for the direction intent
-      return "direction"
-    elif command.lower() == "look" or command.lower() == "l":
-      # when the user issues a "look" command, re-describe what they see
-      return "redescribe"
-    elif "examine " in command or command.lower().startswith("x "):
-      return "examine"
-    elif  "take " in command or "get " in command:
-      return "take"
-    elif "drop " in command:
-      return "drop"
-    elif "inventory" in command or command.lower() == "i":
-      return "inventory"
-    else: 
-      for item in self.game.get_items_in_scope():
-        special_commands = item.get_commands()
-        for special_command in special_commands:
-          if command == special_command.lower():
-            return "special"
+      return ("sequence", None, None, None)
+    words = command.split()
+    if len(words) > 2 and words[0] == "go" and words[1] == "to":
+      # Travel to a location by name.  The destination goes where the
+      # direction would, and is None if there's no location by that name.
+      return ("travel", self.game.paths.find(" ".join(words[2:])), None, None)
+    direction = self.match_direction(words)
+    if direction:
+      return ("direction", direction, None, None)
+    command = " ".join(words)
+    intent = self.EXACT_INTENTS.get(command)
+    if intent:
+      return (intent, None, None, None)
+    if words:
+      intent = self.LEADING_VERB_INTENTS.get(words[0])
+    for word in words:
+      if intent:
+        break
+      intent = self.VERB_INTENTS.get(word)
+    if intent in self.ITEM_SCOPES:
+      in_location, in_inventory = self.ITEM_SCOPES[intent]
+      item = self.match_item(words, in_location, in_inventory)
+      return (intent, None, item, None)
+    if intent:
+      return (intent, None, None, None)
+    special = self.game.find_special_command(command)
+    if special:
+      item, action = special
+      return ("special", None, item, action)
+    return (None, None, None, None)
 
   def parse_command(self, command):
     # add this command to the history
@@ -346,42 +1562,95 @@ class Parser:
 
     end_game = False
 
-    # Intents are functions that can be executed
-    intent = self.get_player_intent(command)
+    # Intents are functions that can be executed.  If the game has a 
+    # profiler, the time spent on each phase of the command is recorded.
+    profiler = self.game.profiler
+    if profiler is not None:
+      started = profiler.clock()
+    intent, direction, item, action = self.route_command(command)
+    if profiler is not None:
+      routed = profiler.clock()
+      profiler.observe("intent", routed - started)
+      profiler.count("commands", intent or "unknown")
+
+    # Record the changes this command makes so that it can be undone, unless
+    # it is part of a sequence that is already being recorded.
+    # The output of the command is written in one go when it has finished.
+    history = self.game.history
+    outermost = history.step is None
+    record = outermost and intent not in ("undo", "redo")
+    if record:
+      history.begin_step()
+    try:
+      end_game = self.run_intent(command, intent, direction, item, action)
+    finally:
+      if record:
+        history.end_step()
+      if profiler is not None:
+        ran = profiler.clock()
+        profiler.observe("run", ran - routed)
+      if outermost:
+        self.game.output.flush()
+        if profiler is not None:
+          finished = profiler.clock()
+          profiler.observe("output", finished - ran)
+          profiler.observe("command", finished - started)
+    return end_game
+
+  def run_intent(self, command, intent, direction, item, action):
+    end_game = False
     if intent == "direction":
-      end_game = self.go_in_direction(command)
+      end_game = self.go_in_direction(direction)
+    elif intent == "travel":
+      end_game = self.travel(direction)
     elif intent == "redescribe":
       self.game.describe()
     elif intent == "examine":
-      self.examine(command)
+      self.examine(item)
     elif intent == "take":
-      end_game = self.take(command)
+      end_game = self.take(item)
     elif intent == "drop":
-      self.drop(command)
+      self.drop(item)
     elif intent == "inventory":
-      self.check_inventory(command)
+      self.check_inventory()
     elif intent == "special":
-      end_game = self.run_special_command(command)
+      end_game = self.run_special_command(item, action)
     elif intent == "sequence":
       end_game = self.execute_sequence(command)
+    elif intent == "undo":
+      self.undo()
+    elif intent == "redo":
+      self.redo()
     else:
-      print("I'm not sure what you want to do.")
+      self.game.output.print("I'm not sure what you want to do.")
     return end_game
 
   ### Intent Functions ###
 
-  def go_in_direction(self, command):
+  def simulate(self, command, observe=None):
+    """Work out what would happen if the player entered a command, without
+       changing the game.  Returns a DryRun with the changes the command would
+       make, what it would print, and whether it would end the game.  If an 
+       observe function is given, it is called with the game after the 
+       command has run and before it is undone, and its result is kept in the
+       DryRun's observed field."""
+    with self.game.dry_run(self.command_history) as result:
+      result.end_game = self.parse_command(command)
+      if observe:
+        result.observed = observe(self.game)
+    return result
+
+  def go_in_direction(self, direction):
     """ The user wants to in some direction """
-    direction = self.get_direction(command)
-
     if direction:
       if direction in self.game.curr_location.connections:
         if self.game.curr_location.is_blocked(direction, self.game):
           # check to see whether that direction is blocked.
-          print(self.game.curr_location.get_block_description(direction))
+          self.game.output.print(self.game.curr_location.get_block_description(direction))
         else:
           # if it's not blocked, then move there 
           self.game.curr_location = self.game.curr_location.connections[direction]
+          self.game.visit(self.game.curr_location)
 
           # If moving to this location ends the game, only describe the location
           # and not the available items or actions.
@@ -390,106 +1659,106 @@ class Parser:
           else:
             self.game.describe()
       else:
-        print("You can't go %s from here." % direction.capitalize())
+        self.game.output.print("You can't go %s from here." % direction.capitalize())
     return self.game.curr_location.end_game
 
-  def check_inventory(self,command):
+  def travel(self, destination):
+    """ The player wants to go to a location along the shortest path, which
+        only describes where they end up """
+    game = self.game
+    if not destination:
+      game.output.print("I don't know where that is.")
+      return False
+    if destination is game.curr_location:
+      game.output.print("You are already there.")
+      return False
+    path = game.paths.path(game.curr_location, destination)
+    if path is None:
+      game.output.print("You can't find a way to the %s from here." % destination.name)
+      return False
+    for direction in path:
+      location = game.curr_location
+      if location.is_blocked(direction, game):
+        game.output.print(location.get_block_description(direction))
+        break
+      game.curr_location = location.connections[direction]
+      game.visit(game.curr_location)
+      if game.curr_location.end_game:
+        game.describe_current_location()
+        return True
+    game.describe()
+    return False
+
+  def check_inventory(self):
     """ The player wants to check their inventory"""
     if len(self.game.inventory) == 0:
-      print("You don't have anything.")
+      self.game.output.print("You don't have anything.")
     else:
       descriptions = []
       for item_name in self.game.inventory:
         item = self.game.inventory[item_name]
         descriptions.append(item.description)
-      print("You have: ", end = '')
-      print(*descriptions, sep = ", ",)
+      self.game.output.print("You have: ", end = '')
+      self.game.output.print(*descriptions, sep = ", ",)
   
 
-  def examine(self, command):
+  def examine(self, item):
     """ The player wants to examine something """
-    command = command.lower()
-    matched_item = False
-    # check whether any of the items at this location match the command
-    for item_name in self.game.curr_location.items:
-      if item_name in command:
-        item = self.game.curr_location.items[item_name]
-        if item.examine_text:
-          print(item.examine_text)
-          matched_item = True
-        break
-    # check whether any of the items in the inventory match the command
-    for item_name in self.game.inventory:
-      if item_name in command:
-        item = self.game.inventory[item_name]
-        if item.examine_text:
-          print(item.examine_text)
-          matched_item = True
-    # fail
-    if not matched_item:
-      print("You don't see anything special.")
+    if item and item.examine_text:
+      self.game.output.print(item.examine_text)
+    else:
+      self.game.output.print("You don't see anything special.")
 
 
-  def take(self, command):
+  def take(self, item):
     """ The player wants to put something in their inventory """
-    command = command.lower()
-    matched_item = False
-
     # This gets set to True if posession of this object ends the game.
     end_game = False
 
-    # check whether any of the items at this location match the command
-    for item_name in self.game.curr_location.items:
-      if item_name in command:
-        item = self.game.curr_location.items[item_name]
-        if item.gettable:
-          self.game.add_to_inventory(item)
-          self.game.curr_location.remove_item(item)
-          print(item.take_text)
-          end_game = item.end_game
-        else:
-          print("You cannot take the %s." % item_name)
-        matched_item = True
-        break
-    # check whether any of the items in the inventory match the command
-    if not matched_item:
-      for item_name in self.game.inventory:
-        if item_name in command:
-          print("You already have the %s." % item_name)
-          matched_item = True
-    # fail
-    if not matched_item:
-      print("You can't find it.")
+    if not item:
+      self.game.output.print("You can't find it.")
+    elif self.game.is_in_inventory(item):
+      self.game.output.print("You already have the %s." % item.name)
+    elif item.gettable:
+      self.game.curr_location.remove_item(item)
+      self.game.add_to_inventory(item)
+      self.game.output.print(item.take_text)
+      end_game = item.end_game
+    else:
+      self.game.output.print("You cannot take the %s." % item.name)
 
     return end_game
 
-  def drop(self, command):
+  def drop(self, item):
     """ The player wants to remove something from their inventory """
-    command = command.lower()
-    matched_item = False
-    # check whether any of the items in the inventory match the command
-    if not matched_item:
-      for item_name in self.game.inventory:
-        if item_name in command:
-          matched_item = True
-          item = self.game.inventory[item_name]
-          self.game.curr_location.add_item(item_name, item)
-          self.game.inventory.pop(item_name)
-          print("You drop the %s." % item_name)
-          break
-    # fail
-    if not matched_item:
-      print("You don't have that.")
+    if item:
+      self.game.remove_from_inventory(item)
+      self.game.curr_location.add_item(item.name, item)
+      self.game.output.print("You drop the %s." % item.name)
+    else:
+      self.game.output.print("You don't have that.")
 
 
-  def run_special_command(self, command):
+  def run_special_command(self, item, action):
     """Run a special command associated with one of the items in this location
        or in the player's inventory"""
-    for item in self.game.get_items_in_scope():
-        special_commands = item.get_commands()
-        for special_command in special_commands:
-          if command == special_command.lower():
-            return item.do_action(special_command, self.game)
+    return item.do_action(action, self.game)
+
+  def undo(self):
+    """ The player wants to take back their last command """
+    if self.game.undo():
+      self.game.output.print("You undo your last command.")
+      self.game.describe()
+    else:
+      self.game.output.print("There is nothing to undo.")
+
+  def redo(self):
+    """ The player wants to repeat a command they took back """
+    if self.game.redo():
+      self.game.output.print("You redo your last command.")
+      self.game.describe()
+    else:
+      self.game.output.print("There is nothing to redo.")
 
   def execute_sequence(self, command):
     for cmd in command.split(","):
@@ -497,27 +1766,54 @@ class Parser:
       self.parse_command(cmd)
 
   def get_direction(self, command):
-    command = command.lower()
-    if command == "n" or "north" in command:
-      return "north" 
-    if command == "s" or "south" in command:
-      return "south"
-    if command == "e" or "east" in command: 
-      return "east"
-    if command == "w" or "west" in command:
-      return "west"
-    if command == "up":
-      return "up"
-    if command == "down":
-      return "down"
-    if command.startswith("go out"):
-      return "out"
-    if command.startswith("go in"):
-      return "in"
-    for exit in self.game.curr_location.connections.keys():
-      if command == exit.lower() or command == "go " + exit.lower():
-        return exit
-    return None
+    return self.match_direction(command.lower().split())
+
+  def match_direction(self, words):
+    """Look up the direction named by an already tokenized command, in the
+       game's directions: a single-word command that names one, a compass
+       direction anywhere in the command, or a direction after "go"."""
+    directions = self.game.directions
+    if len(words) == 1 and words[0] in directions.commands:
+      return directions.commands[words[0]]
+    for word in words:
+      if word in directions.words:
+        return directions.words[word]
+    if len(words) > 1 and words[0] == "go" and words[1] in directions.go_words:
+      return directions.go_words[words[1]]
+    # Otherwise check the exits of the current location, either by themselves
+    # or preceded by "go".
+    exit = " ".join(words[1:] if words[:1] == ["go"] else words)
+    return self.game.curr_location.find_exit(exit)
+
+  def match_item(self, words, in_location=True, in_inventory=True):
+    """Find the item in scope whose name or alias appears in the lowercase
+       words of the command as whole words.  The longest name wins, then the
+       one nearest the start of the command, then the one in the current
+       location.  If no name appears exactly, punctuation is taken off the
+       words, and then the words other than verbs are matched allowing for a
+       misspelling."""
+    location_index = self.game.curr_location.special_commands if in_location else None
+    inventory_index = self.game.inventory_commands if in_inventory else None
+    best = None
+    if location_index is not None:
+      best = location_index.match_name(words)
+    if inventory_index is not None:
+      best = inventory_index.match_name(words, best)
+    if best is None:
+      stripped = name_words(" ".join(words))
+      if stripped != words:
+        if location_index is not None:
+          best = location_index.match_name(stripped)
+        if inventory_index is not None:
+          best = inventory_index.match_name(stripped, best)
+      if best is None:
+        words = [word for word in stripped
+                 if word not in self.VERB_INTENTS and word not in self.LEADING_VERB_INTENTS]
+        if location_index is not None:
+          best = location_index.match_fuzzy(words)
+        if inventory_index is not None:
+          best = inventory_index.match_fuzzy(words, best)
+    return best[2] if best else None
 
 
 # ## Special functions
@@ -532,27 +1828,35 @@ def add_item_to_inventory(game, *args):
   """ Add a newly created Item and add it to your inventory."""
   (item, action_description, already_done_description) = args[0]
   if(not game.is_in_inventory(item)):
-    print(action_description)
+    game.output.print(action_description)
     game.add_to_inventory(item)
   else:
-    print(already_done_description)
+    game.output.print(already_done_description)
   return False
 
 def describe_something(game, *args):
   """Describe some aspect of the Item"""
   (description) = args[0]
-  print(description)
+  game.output.print(description)
+  return False
+
+def tell_joke(game, *args):
+  """Tell a new programming joke, after an introduction like "He says: ".
+     pyjokes is only imported when someone tells a joke."""
+  import pyjokes
+  (introduction) = args[0]
+  game.output.print(introduction + pyjokes.get_joke())
   return False
 
 def destroy_item(game, *args):
   """Removes an Item from the game by setting its location is set to None."""
   (item, action_description) = args[0]
   if game.is_in_inventory(item):
-    game.inventory.pop(item.name)
-    print(action_description)
+    game.remove_from_inventory(item)
+    game.output.print(action_description)
   elif item.name in game.curr_location.items:
     game.curr_location.remove_item(item)
-    print(action_description)
+    game.output.print(action_description)
   else:
     pass
     # print(already_done_description)
@@ -566,17 +1870,24 @@ def destroy_item_location(game, *args):
 def create_item(game, *args):
   item, description = args[0]
   game.curr_location.add_item(item.name, item)  
-  print(description)
+  game.output.print(description)
 
 def create_item_location(game, *args):
   item, description, location = args[0]
   location.add_item(item.name, item)  
-  print(description)
+  game.output.print(description)
 
 def end_game(game, *args):
   """Ends the game."""
   end_message = args[0]
-  print(end_message)
+  game.output.print(end_message)
+  return True
+
+def win_game(game, *args):
+  """Ends the game with the player winning."""
+  end_message = args[0]
+  game.output.print(end_message)
+  game.won = True
   return True
 
 def perform_multiple_actions(game, *args):
@@ -599,19 +1910,14 @@ def perform_multiple_actions(game, *args):
 
 # In[7]:
 
-basement = Location("Towne Basement", "You are standing in a creepy basement. There is an eternal loud humming sound.")
-towne327 = Location("Towne 327", "You are standing in a classroom. There is an awkward silence as people try to understand what 'AI' actually means. There's an ethernet outlet here, but who ever brings ethernet cables?")
-broken_hub = Item("wifi hub", "a broken wifi hub", "the wifi hub isn't connecting devices to the internet", start_at=None, gettable=False)
-ethernet_cable = Item("ethernet cable", "a short ethernet cable", "the ethernet cable conveniently has USB-C", start_at=basement)
-laptop = Item("laptop", "your laptop", "your laptop already has Github and your IDE open")
-laptop.add_action("finish homework", end_game, ("Daphne calls CETS and they take long enough for class to get delayed. You finish your homework with your wired internet connection. You win! Start earlier next time!"), preconditions={"in_location": towne327, "inventory_contains": ethernet_cable, "location_has_item": broken_hub})
-
 def build_game():
   # Locations
   hallway = Location("Towne Hallway", "Your assignment is due in 15 minutes. You are standing in a hallway. Dozens of undergraduates complain loudly about CIS 160. There is also a staircase at the end of the hall.")
   towne100 = Location("Towne 100", "You are standing in a lecture hall. It recently got renovated, but it's still the colour of overripe banana and smells like food truck.")
   stairs = Location("Towne Staircase", "You are standing in a staircase. It looks vaguely decrepit, but you can't tell how old.")
   upper_hallway= Location("Towne Upstairs Hallway", "You are standing in a hallway. It's weirdly quiet and all the rooms are locked except for one.")
+  basement = Location("Towne Basement", "You are standing in a creepy basement. There is an eternal loud humming sound.")
+  towne327 = Location("Towne 327", "You are standing in a classroom. There is an awkward silence as people try to understand what 'AI' actually means. There's an ethernet outlet here, but who ever brings ethernet cables?")
 
   hallway.add_connection("in", towne100)
   hallway.add_connection("north", stairs)
@@ -625,6 +1931,9 @@ def build_game():
   upper_hallway.add_connection("in", towne327)
 
   # Items
+  broken_hub = Item("wifi hub", "a broken wifi hub", "the wifi hub isn't connecting devices to the internet", start_at=None, gettable=False)
+  ethernet_cable = Item("ethernet cable", "a short ethernet cable", "the ethernet cable conveniently has USB-C", start_at=basement)
+  laptop = Item("laptop", "your laptop", "your laptop already has Github and your IDE open")
   router = Item("router", "a big internet router", "the router is plugged into the wall", start_at=basement, gettable=False)
   unplugged_router = Item("unplugged Router", "an unplugged internet router", "the router looks lifeless", start_at=None, gettable=False)
   hub = Item("wifi hub", "a wifi hub", "the wifi hub is relaying signal in the room", start_at=towne327, gettable=False)
@@ -632,8 +1941,8 @@ def build_game():
   ccb = Item("chris", "Chris", "a professor is standing here, wearing a floral shirt", start_at=towne327, gettable=False)
   daphne = Item("daphne", "Daphne", "a PhD instructor is standing here, checking course material and reveling in her fast internet connection", start_at=towne327, gettable=False)
 
-  ccb.add_action("talk to chris", describe_something, ("He says: " + pyjokes.get_joke()))
-  daphne.add_action("talk to daphne", describe_something, ("She says: " + pyjokes.get_joke()))
+  ccb.add_action("talk to chris", tell_joke, "He says: ")
+  daphne.add_action("talk to daphne", tell_joke, "She says: ")
 
   router.add_action("unplug router", perform_multiple_actions, ([
     (destroy_item, (router, "You unplug the router from the wall.")),
@@ -644,7 +1953,11 @@ def build_game():
 
   fire_alarm.add_action("pull alarm", end_game, ("You pull the fire alarm and the police arrive, diverting units from a serious situation. You die from grief. Game over."))
 
-  return Game(hallway)
+  laptop.add_action("finish homework", win_game, ("Daphne calls CETS and they take long enough for class to get delayed. You finish your homework with your wired internet connection. You win! Start earlier next time!"), preconditions={"in_location": towne327, "inventory_contains": ethernet_cable, "location_has_item": broken_hub})
+
+  game = Game(hallway)
+  game.add_to_inventory(laptop)
+  return game
 
 # # Play the game
 # This small snippet of code is what you need to run the game.  Behold! The magestic prompt! 
@@ -655,8 +1968,7 @@ def game_loop():
   game = build_game()
   parser = Parser(game)
   game.describe()
-
-  game.add_to_inventory(laptop)
+  game.output.flush()
 
   command = ""
   while not (command.lower() == "exit" or command.lower == "q"):
@@ -665,79 +1977,30 @@ def game_loop():
     if end_game:
       return
 
-game_loop()
-print('THE GAME HAS ENDED.')
-
 
 # # Visualize your game
-# The code below allows you to create a directed graph that shows the locations in your game and how they are connected.  You can also save a PDF of your graph to your Google Drive with the `save_to_drive` method.  The output file will be called `game-visualization.pdf`.
+# The code below allows you to create a directed graph that shows the locations in your game and how they are connected.  The graph is written by `mapexport.py`, which can also write it as JSON Lines or GraphML, and `visualize()` returns it as a graphviz `Source`, which a notebook displays and which can be rendered to a file with `render()`.
 
 # In[ ]:
 
 
-#!pip install graphviz
-# from graphviz import Digraph
-# from IPython.display import Image
-# import queue
-
-def DFS(game, graph):
-  """Do a depth-first-search traversal of the locations in the game
-     starting at the start location, and create a GraphViz graph 
-     to vizualize the connections between the locations, and the items
-     that are located at each location."""
-  start_location = game.curr_location
-  frontier = queue.Queue()
-  frontier.put(start_location)
-  visited = {}
-  visited[start_location.name] = True
-
-  while not frontier.empty():
-    current_location = frontier.get()
-    game.curr_location = current_location
-    name = current_location.name
-    description = current_location.description
-    items = current_location.items
-    items_html = describe_items(current_location)
-    html = "<<b>%s</b><br />%s<br />%s>" % (name, description, items_html)
-    # Create a new node in the graph for this location
-    graph.node(name, label=html)  
-
-    connections = current_location.connections
-    for direction in connections.keys():
-      next_location = connections[direction]
-      if not current_location.is_blocked(direction, game):
-        # Create an edge between the current location and its successor
-        graph.edge(name, next_location.name, label=direction.capitalize())
-      else:
-        # Create a dotted edge for connected locations that are blocked
-        block_description = "%s\n%s" % (direction.capitalize(), current_location.get_block_description(direction))
-        graph.edge(name, next_location.name, label=block_description, style="dotted")
-      if not next_location.name in visited:
-        visited[next_location.name] = True
-        frontier.put(next_location)
-
-def describe_items(location, print_commands=True):
-    """Describe what objects are in the current location."""
-    items_html = ""
-    if len(location.items.keys()) > 0:
-      items_html = "You see: "
-    for item_name in location.items:
-      item = location.items[item_name]
-      items_html += item.description
-      if print_commands:
-        special_commands = item.get_commands()
-        for cmd in special_commands:
-          items_html += "<br/><i>%s</i>" % cmd
-    return items_html
-
-def save_to_drive(graph):
-  from google.colab import drive
-  drive.mount('/content/drive/')
-  graph.render('/content/drive/My Drive/game-visualization', view=True)  
-
-"""graph = Digraph(node_attr={'color': 'lightblue2', 'style': 'filled'})
-game = build_game()
-DFS(game, graph)
-#save_to_drive(graph)
-graph"""
-
+def visualize(game=None):
+  """Returns a GraphViz graph of the locations in the game, which is built 
+     with build_game() if it isn't given.  The graph is written in the DOT
+     language by mapexport.MapExporter, which checks the blocks without
+     moving the player.  graphviz is only imported when a graph is made, so
+     that importing the game stays fast."""
+  from graphviz import Source
+  from mapexport import MapExporter
+  out = io.StringIO()
+  MapExporter(game or build_game()).export(out, "dot")
+  return Source(out.getvalue())
+
+if __name__ == "__main__":
+  if sys.argv[1:] == ["--visualize"]:
+    # Print the graph in the DOT language, which doesn't need graphviz.
+    from mapexport import export_map
+    export_map(build_game(), sys.stdout, "dot")
+  else:
+    game_loop()
+    print('THE GAME HAS ENDED.')
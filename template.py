@@ -0,0 +1,192 @@
+"""Share one copy of a game's world between many players.
+
+Most of a game never changes while it is played: the descriptions, the
+connections between locations, the blocks, and the actions of the items.  A
+WorldTemplate builds all of that once, with the engine module's
+`build_game()`.  Each player gets an Overlay, which only holds what their
+commands have changed: where the player is, the items that are not where
+they started, the locations whose visited flags differ from the start,
+whether they have won, and their undo history.
+
+Before an overlay runs a command, the changes of the overlay that used the
+world last are undone and the new overlay's changes are made, so switching
+between players takes time proportional to how much of the world they have
+changed, not to the size of the world.  The world keeps track of the items
+and locations that commands touch (see `Game.touched`), so taking the
+changes back out afterwards only looks at those.  Starting a session costs
+almost nothing, so thousands of sessions take little more memory than one
+world.  Commands from different overlays must not run at the same time,
+which is the case on an asyncio event loop.
+
+```
+template = WorldTemplate("task2")
+session = template.new_session()
+session.run_command("north")
+```
+"""
+
+from array import array
+
+from replay import load_engine
+
+
+class WorldTemplate:
+  """The parts of a game that every player shares."""
+  def __init__(self, engine, history_limit=None):
+    self.engine = load_engine(engine)
+    self.game = self.engine.build_game()
+    self.parser = self.engine.Parser(self.game)
+    # The state of the world when a game starts.
+    self.initial_state = self.game.export_state()
+    # Where each item is when a game starts, by item id (see
+    # Game.get_placement()).
+    self.initial_placements = array("I")
+    self.initial_placements.frombytes(self.initial_state[1])
+    # Dictionary mapping from each location that has items when a game
+    # starts to the list of them, in the order they are listed.
+    self.initial_items = {location: list(location.items.values())
+                          for location in self.game.locations if location.items}
+    self.game.touched = set()
+    # How many commands each player can undo, or None for no limit.
+    self.history_limit = history_limit
+    # The overlay that is using the world, or None.
+    self.active = None
+    # The overlay whose changes the world is holding, or None if the world
+    # is as it was at the start.
+    self.applied = None
+
+  def new_session(self, output=None):
+    """Returns an Overlay for a new player, starting at the beginning.  The
+       player's output goes to the given sink, or to the console."""
+    return Overlay(self, output)
+
+  def initial_placement(self, item):
+    """Returns where an item was when the game started."""
+    if item.id is None or item.id >= len(self.initial_placements):
+      return 0
+    return self.initial_placements[item.id]
+
+  def initially_visited(self, location):
+    """Returns True if a location was visited when the game started."""
+    return location.id is not None and bool(self.initial_state[2] >> location.id & 1)
+
+  def activate(self, overlay):
+    """Put the world into the overlay's state, first saving the state of the
+       overlay that was active.  Only the facts that one of the two overlays
+       has changed are touched."""
+    if self.active is overlay:
+      return
+    game = self.game
+    if self.active is not None:
+      self.active.save()
+    if self.applied is not overlay:
+      if self.applied is not None:
+        placements, visited = self.applied.placements, self.applied.visited
+      else:
+        placements, visited = {}, {}
+      moved = [(item, self.initial_placement(item)) for item in placements
+               if item not in overlay.placements]
+      moved.extend((item, placement) for item, placement in overlay.placements.items()
+                   if placements.get(item, self.initial_placement(item)) != placement)
+      self.place_items(moved, overlay)
+      for location, was_visited in visited.items():
+        if location not in overlay.visited:
+          game.set_visited(location, not was_visited)
+      for location, is_visited in overlay.visited.items():
+        game.set_visited(location, is_visited)
+      game.curr_location = overlay.location
+      game.touched.clear()
+      self.applied = overlay
+    game.history = overlay.history
+    game.won = overlay.won
+    game.output = overlay.output
+    self.active = overlay
+
+  def place_items(self, moved, overlay):
+    """Move items for a switch to the overlay, and then put the items in
+       each location they moved out of or into back in a fixed order: the
+       order the location's items start in, followed by the items the
+       overlay has moved there.  Otherwise moving items out and back would
+       change the order that other players see them listed in, and which of
+       them wins a tie when a command is matched."""
+    game = self.game
+    locations = game.locations
+    changed = set()
+    for item, placement in moved:
+      if isinstance(item.holder, self.engine.Location):
+        changed.add(item.holder)
+      if placement > 1:
+        changed.add(locations[placement - 2])
+    game.place_items(moved)
+    if not changed:
+      return
+    moved_in = {}
+    for item, placement in overlay.placements.items():
+      if placement > 1:
+        moved_in.setdefault(locations[placement - 2], []).append(item)
+    for location in changed:
+      location.order_items(self.initial_items.get(location, []) + moved_in.get(location, []))
+
+  def release(self, overlay):
+    """Stop using the world for the overlay, keeping its state."""
+    if self.active is overlay:
+      overlay.save()
+      self.active = None
+
+
+class Overlay:
+  """One player's changes to a shared WorldTemplate."""
+  def __init__(self, template, output=None):
+    self.template = template
+    # The output sink for the player's commands.
+    self.output = output or template.engine.BufferedSink()
+    # Where the player is.
+    self.location = template.game.locations[template.initial_state[0]]
+    # Dictionary mapping from each item that is not where it started to
+    # where it is, as a number from Game.get_placement().
+    self.placements = {}
+    # Dictionary mapping from each location whose visited flag differs from
+    # the start to the flag.
+    self.visited = {}
+    # The player's undo history.
+    self.history = template.engine.History(template.history_limit)
+    # True if the player has won the game.
+    self.won = False
+
+  def save(self):
+    """Take the player's changes back out of the template's world, looking
+       only at the items and locations that have been touched since the
+       last time."""
+    template = self.template
+    game = template.game
+    for thing in game.touched:
+      if isinstance(thing, template.engine.Location):
+        if thing.has_been_visited != template.initially_visited(thing):
+          self.visited[thing] = thing.has_been_visited
+        else:
+          self.visited.pop(thing, None)
+      else:
+        placement = game.get_placement(thing)
+        if placement != template.initial_placement(thing):
+          self.placements[thing] = placement
+        else:
+          self.placements.pop(thing, None)
+    game.touched.clear()
+    self.location = game.curr_location
+    self.won = game.won
+
+  def describe(self):
+    """Describe where the player is."""
+    self.template.activate(self)
+    self.template.game.describe()
+    self.output.flush()
+
+  def run_command(self, command):
+    """Run one of the player's commands.  Returns True if it ended the
+       game."""
+    self.template.activate(self)
+    return self.template.parser.parse_command(command)
+
+  def close(self):
+    """Let go of the template's world when the player leaves."""
+    self.template.release(self)
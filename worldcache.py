@@ -0,0 +1,370 @@
+"""Compile worlds into a binary cache that can be opened without parsing.
+
+A world file has to be parsed as JSON every time a process starts, and a
+world built by `build_game()` has to be built.  This module compiles either
+of them into a compact binary file, which is memory-mapped when it is
+opened.  Nothing is decoded until a WorldLoader asks for it, so opening a
+cached world takes about the same time however large the world is.
+
+The file starts with a header holding the SHA-256 hash of the source it was
+compiled from (the world file, or the game module's source code), so a cache
+is recompiled when its source changes.  After the header come these tables:
+
+* strings: every distinct string, stored once, as an array of offsets into
+  a block of UTF-8 text.  Everything else refers to strings by their index.
+* locations: one fixed-size record per location, with its name,
+  description, region, and the ranges of its connections, blocks and
+  starting items in the tables below.
+* connections: (direction, target location, travel description) records,
+  so the map is a set of adjacency arrays.
+* blocks: (direction, description, preconditions) records.
+* regions: the range of each region's locations in an array of location
+  numbers.
+* items: one record per item, with the location it starts at and the range
+  of its actions.
+* actions: (command, special function name, arguments, preconditions)
+  records, where the arguments and preconditions are compact JSON in which
+  references to items and locations have already been turned into their
+  numbers.
+
+Locations and items are known by their numbers in these tables, which are
+the keys that a WorldLoader sees.
+
+```
+python3 worldcache.py compile worlds/action_castle.json
+python3 worldcache.py compile --engine task2
+python3 worldcache.py play task1 worlds/action_castle.json
+```
+"""
+
+import argparse
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from replay import load_engine
+from worldfile import WorldData, dump_world, play
+
+MAGIC = b"TAWC"
+VERSION = 2
+
+HEADER = struct.Struct("<4sI32s18I")
+LOCATION = struct.Struct("<IIIIBIIIIII")
+CONNECTION = struct.Struct("<III")
+BLOCK = struct.Struct("<III")
+REGION = struct.Struct("<II")
+ITEM = struct.Struct("<IIIIIIiBII")
+ACTION = struct.Struct("<IIII")
+
+# Flags in an item record.
+GETTABLE = 1
+END_GAME = 2
+
+
+class CompiledWorld:
+  """A compiled world, read straight from a buffer such as a memory-mapped
+     cache file.  It has the same methods as a WorldData, so it can be given
+     to load_world()."""
+  def __init__(self, buffer):
+    # The bytes of the compiled world.
+    self.buffer = buffer
+    fields = HEADER.unpack_from(buffer, 0)
+    magic, version, self.digest = fields[:3]
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("Not a compiled world")
+    (self.string_count, self.strings_offset, self.text_offset,
+     self.location_count, self.locations_offset, self.connections_offset,
+     self.blocks_offset, self.region_count, self.regions_offset,
+     self.region_locations_offset, self.item_count, self.items_offset,
+     self.start_items_offset, self.actions_offset, inventory_count,
+     inventory_offset, self.start, print_commands) = fields[3:]
+    self.inventory = self.numbers(inventory_offset, inventory_count)
+    self.print_commands = bool(print_commands)
+    # Dictionaries mapping from numbers to the strings, locations and items
+    # that have been decoded so far.
+    self.strings = {}
+    self.locations = {}
+    self.items = {}
+
+  def string(self, number):
+    string = self.strings.get(number)
+    if string is None:
+      start, end = struct.unpack_from("<II", self.buffer, self.strings_offset + 4 * number)
+      start += self.text_offset
+      end += self.text_offset
+      string = sys.intern(bytes(self.buffer[start:end]).decode("utf-8"))
+      self.strings[number] = string
+    return string
+
+  def numbers(self, offset, count):
+    """Returns a list of count unsigned 32-bit numbers from the offset."""
+    return list(struct.unpack_from("<%dI" % count, self.buffer, offset))
+
+  def location_record(self, number):
+    return LOCATION.unpack_from(self.buffer, self.locations_offset + LOCATION.size * number)
+
+  def location_data(self, number):
+    """Returns the dictionary describing a location, or None."""
+    if not isinstance(number, int) or not 0 <= number < self.location_count:
+      return None
+    data = self.locations.get(number)
+    if data is None:
+      (key, name, description, region, end_game, connection_start,
+       connection_count, block_start, block_count, item_start,
+       item_count) = self.location_record(number)
+      data = {"name": self.string(name), "description": self.string(description),
+              "end_game": bool(end_game), "connections": {},
+              "travel_descriptions": {}, "blocks": {}}
+      for i in range(connection_start, connection_start + connection_count):
+        direction, target, travel_description = CONNECTION.unpack_from(
+          self.buffer, self.connections_offset + CONNECTION.size * i)
+        data["connections"][self.string(direction)] = target
+        data["travel_descriptions"][self.string(direction)] = self.string(travel_description)
+      for i in range(block_start, block_start + block_count):
+        direction, description, preconditions = BLOCK.unpack_from(
+          self.buffer, self.blocks_offset + BLOCK.size * i)
+        data["blocks"][self.string(direction)] = {
+          "description": self.string(description),
+          "preconditions": json.loads(self.string(preconditions))}
+      self.locations[number] = data
+    return data
+
+  def item_data(self, number):
+    """Returns the dictionary describing an item, or None."""
+    if not isinstance(number, int) or not 0 <= number < self.item_count:
+      return None
+    data = self.items.get(number)
+    if data is None:
+      (key, name, description, examine_text, take_text, aliases, start_at, flags,
+       action_start, action_count) = ITEM.unpack_from(
+        self.buffer, self.items_offset + ITEM.size * number)
+      data = {"name": self.string(name), "description": self.string(description),
+              "examine_text": self.string(examine_text),
+              "take_text": self.string(take_text),
+              "aliases": json.loads(self.string(aliases)),
+              "start_at": start_at if start_at >= 0 else None,
+              "gettable": bool(flags & GETTABLE), "end_game": bool(flags & END_GAME),
+              "actions": []}
+      for i in range(action_start, action_start + action_count):
+        command, function, arguments, preconditions = ACTION.unpack_from(
+          self.buffer, self.actions_offset + ACTION.size * i)
+        data["actions"].append({
+          "command": self.string(command), "function": self.string(function),
+          "arguments": json.loads(self.string(arguments)),
+          "preconditions": json.loads(self.string(preconditions))})
+      self.items[number] = data
+    return data
+
+  def region_of(self, number):
+    return self.location_record(number)[3]
+
+  def region_locations(self, region):
+    start, count = REGION.unpack_from(self.buffer, self.regions_offset + REGION.size * region)
+    return self.numbers(self.region_locations_offset + 4 * start, count)
+
+  def all_regions(self):
+    return range(self.region_count)
+
+  def items_starting_at(self, number):
+    record = self.location_record(number)
+    return self.numbers(self.start_items_offset + 4 * record[9], record[10])
+
+
+def compile_world(world, digest=b""):
+  """Compile a world file, given as a dictionary, into the bytes of a
+     compiled world.  The digest is the hash of the source it came from."""
+  data = WorldData(world)
+  location_keys = list(data.locations)
+  item_keys = list(data.items)
+  location_numbers = {key: i for i, key in enumerate(location_keys)}
+  item_numbers = {key: i for i, key in enumerate(item_keys)}
+  region_keys = data.all_regions()
+  region_numbers = {region: i for i, region in enumerate(region_keys)}
+
+  strings = {}
+  def string(text):
+    return strings.setdefault(text or "", len(strings))
+
+  def resolve(value):
+    """Replace the keys in references with numbers."""
+    if isinstance(value, dict):
+      if len(value) == 1:
+        (kind, name), = value.items()
+        if kind == "item":
+          return {"item": item_numbers[name]}
+        if kind == "location":
+          return {"location": location_numbers[name]}
+      return {key: resolve(entry) for key, entry in value.items()}
+    if isinstance(value, list):
+      return [resolve(entry) for entry in value]
+    return value
+
+  def encode(value):
+    return string(json.dumps(resolve(value), separators=(",", ":")))
+
+  locations = bytearray()
+  connections = bytearray()
+  blocks = bytearray()
+  start_items = array("I")
+  for key in location_keys:
+    location = data.locations[key]
+    connection_start = len(connections) // CONNECTION.size
+    travel_descriptions = location.get("travel_descriptions", {})
+    for direction, target in location.get("connections", {}).items():
+      connections += CONNECTION.pack(string(direction), location_numbers[target],
+                                     string(travel_descriptions.get(direction)))
+    block_start = len(blocks) // BLOCK.size
+    for direction, block in location.get("blocks", {}).items():
+      blocks += BLOCK.pack(string(direction), string(block["description"]),
+                           encode(block.get("preconditions", {})))
+    item_start = len(start_items)
+    start_items.extend(item_numbers[item_key] for item_key in data.items_starting_at(key))
+    locations += LOCATION.pack(
+      string(key), string(location["name"]), string(location["description"]),
+      region_numbers[data.region_of(key)], int(location.get("end_game", False)),
+      connection_start, len(connections) // CONNECTION.size - connection_start,
+      block_start, len(blocks) // BLOCK.size - block_start,
+      item_start, len(start_items) - item_start)
+
+  regions = bytearray()
+  region_locations = array("I")
+  for region in region_keys:
+    keys = data.region_locations(region)
+    regions += REGION.pack(len(region_locations), len(keys))
+    region_locations.extend(location_numbers[key] for key in keys)
+
+  items = bytearray()
+  actions = bytearray()
+  for key in item_keys:
+    item = data.items[key]
+    action_start = len(actions) // ACTION.size
+    for action in item.get("actions", ()):
+      actions += ACTION.pack(string(action["command"]), string(action["function"]),
+                             encode(action.get("arguments")),
+                             encode(action.get("preconditions", {})))
+    flags = (GETTABLE if item.get("gettable", True) else 0) | (END_GAME if item.get("end_game") else 0)
+    start_at = location_numbers[item["start_at"]] if item.get("start_at") else -1
+    items += ITEM.pack(string(key), string(item["name"]), string(item["description"]),
+                       string(item.get("examine_text")), string(item.get("take_text")),
+                       encode(item.get("aliases", [])), start_at, flags, action_start, len(actions) // ACTION.size - action_start)
+
+  inventory = array("I", (item_numbers[key] for key in data.inventory))
+
+  text = bytearray()
+  string_offsets = array("I")
+  for value in strings:
+    string_offsets.append(len(text))
+    text += value.encode("utf-8")
+  string_offsets.append(len(text))
+
+  # Lay the tables out one after another, after the header.
+  sections = [string_offsets.tobytes(), bytes(text), bytes(locations), bytes(connections),
+              bytes(blocks), bytes(regions), region_locations.tobytes(), bytes(items),
+              start_items.tobytes(), bytes(actions), inventory.tobytes()]
+  offsets = []
+  offset = HEADER.size
+  for section in sections:
+    offsets.append(offset)
+    offset += len(section)
+  (strings_offset, text_offset, locations_offset, connections_offset, blocks_offset,
+   regions_offset, region_locations_offset, items_offset, start_items_offset,
+   actions_offset, inventory_offset) = offsets
+  header = HEADER.pack(
+    MAGIC, VERSION, digest.ljust(32, b"\0"), len(strings), strings_offset, text_offset,
+    len(location_keys), locations_offset, connections_offset, blocks_offset,
+    len(region_keys), regions_offset, region_locations_offset,
+    len(item_keys), items_offset, start_items_offset, actions_offset,
+    len(inventory), inventory_offset, location_numbers[data.start],
+    int(data.print_commands))
+  return header + b"".join(sections)
+
+
+def open_compiled(path):
+  """Memory-map a compiled world file and return a CompiledWorld."""
+  with open(path, "rb") as f:
+    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  return CompiledWorld(buffer)
+
+
+def cached_digest(path):
+  """Returns the source hash in the header of a compiled world file, or None
+     if there isn't a usable one."""
+  try:
+    with open(path, "rb") as f:
+      header = f.read(HEADER.size)
+  except OSError:
+    return None
+  if len(header) < HEADER.size:
+    return None
+  magic, version, digest = HEADER.unpack(header)[:3]
+  if magic != MAGIC or version != VERSION:
+    return None
+  return digest
+
+
+def write_atomically(path, data):
+  """Write a file so that other processes never see it half written."""
+  temporary_path = "%s.%d.tmp" % (path, os.getpid())
+  with open(temporary_path, "wb") as f:
+    f.write(data)
+  os.replace(temporary_path, path)
+
+
+def cached_world(path, cache_path=None):
+  """Returns the CompiledWorld for a world file, compiling it first if there
+     is no cache or the world file has changed since it was compiled.  The
+     cache is kept next to the world file unless a cache_path is given."""
+  cache_path = cache_path or os.path.splitext(path)[0] + ".wcache"
+  with open(path, "rb") as f:
+    source = f.read()
+  digest = hashlib.sha256(source).digest()
+  if cached_digest(cache_path) != digest:
+    write_atomically(cache_path, compile_world(json.loads(source), digest))
+  return open_compiled(cache_path)
+
+
+def cached_engine_world(engine, cache_path=None):
+  """Returns the CompiledWorld for the world built by a game module's
+     build_game(), compiling it first if the module's source has changed."""
+  engine = load_engine(engine)
+  source_path = inspect.getsourcefile(engine)
+  cache_path = cache_path or os.path.splitext(source_path)[0] + ".wcache"
+  with open(source_path, "rb") as f:
+    digest = hashlib.sha256(f.read()).digest()
+  if cached_digest(cache_path) != digest:
+    game = engine.build_game()
+    write_atomically(cache_path, compile_world(dump_world(engine, game), digest))
+  return open_compiled(cache_path)
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Compile worlds into binary caches.")
+  commands = arg_parser.add_subparsers(dest="command", required=True)
+  compile_parser = commands.add_parser("compile", help="compile a world file, or a game module's world")
+  compile_parser.add_argument("world", nargs="?", help="world file to compile")
+  compile_parser.add_argument("--engine", help="compile the world of this game module's build_game()")
+  compile_parser.add_argument("-o", "--output", help="where to write the compiled world")
+  play_parser = commands.add_parser("play", help="play a world file from its cache")
+  play_parser.add_argument("engine", help="game module with the engine and special functions")
+  play_parser.add_argument("world", help="world file to play")
+  args = arg_parser.parse_args(argv)
+
+  if args.command == "compile":
+    if args.engine:
+      world = cached_engine_world(args.engine, args.output)
+    elif args.world:
+      world = cached_world(args.world, args.output)
+    else:
+      arg_parser.error("give a world file or --engine")
+    print("%d locations, %d items, %d strings, %d bytes" % (
+      world.location_count, world.item_count, world.string_count, len(world.buffer)))
+  else:
+    play(args.engine, cached_world(args.world))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,430 @@
+"""Load a game's world from a declarative JSON file.
+
+A world file describes the locations and items of a game as data, and
+refers to the special functions of the game module (like
+`add_item_to_inventory` or `end_game`) by name.  It looks like this:
+
+```
+{
+  "start": "cottage",
+  "inventory": ["lamp"],
+  "locations": {
+    "cottage": {
+      "name": "Cottage",
+      "description": "You are standing in a small cottage.",
+      "connections": {"out": "garden_path"}
+    },
+    "garden_path": {
+      "name": "Garden Path",
+      "description": "You are standing on a lush garden path.",
+      "connections": {"in": "cottage"},
+      "blocks": {"north": {"description": "The path is overgrown.",
+                           "preconditions": {"inventory_contains": {"item": "machete"}}}}
+    }
+  },
+  "items": {
+    "lamp": {
+      "name": "lamp",
+      "description": "a lamp",
+      "aliases": ["lantern"],
+      "actions": [{"command": "light lamp", "function": "describe_something",
+                   "arguments": "The lamp is lit."}]
+    }
+  }
+}
+```
+
+Locations and items are named by keys, which must be unique.  Wherever an
+object is needed, in the arguments of an action or in preconditions, it is
+written as `{"item": key}` or `{"location": key}`, a special function is
+written as `{"function": name}`, and lists become tuples.  A location can
+name the `region` that it belongs to, and is in a region of its own
+otherwise.
+
+The Locations and Items are only built when they are needed.  When the
+player moves to a location, the regions of the locations next to it are
+loaded, so that all of its exits lead somewhere; loading a region builds its
+locations, their blocks and the items that start in them.  Objects that are
+referred to by the items and blocks that get built are loaded in turn.  The
+rest of the world stays as data, so starting a game doesn't build the whole
+world.  The solver and shared world templates snapshot every item at once,
+so they should be given a world that is loaded completely, with
+`load_world(..., lazy=False)`.
+
+A world file can be written from a game that is built in Python with
+`dump`, and played with `play`:
+
+```
+python3 worldfile.py dump task1 > worlds/action_castle.json
+python3 worldfile.py play task1 worlds/action_castle.json
+```
+"""
+
+import argparse
+import json
+import re
+import sys
+
+from replay import load_engine
+
+
+class WorldData:
+  """The description of a world from a world file, as the WorldLoader reads
+     it.  Other sources of worlds, like the compiled worlds in worldcache.py,
+     have the same methods."""
+  def __init__(self, world):
+    # The world file, as a dictionary.
+    self.world = world
+    self.locations = world["locations"]
+    self.items = world.get("items", {})
+    # The key of the location where the player starts, the keys of the items
+    # they start with, and whether the special commands are shown.
+    self.start = world["start"]
+    self.inventory = world.get("inventory", ())
+    self.print_commands = world.get("print_commands", True)
+    # Dictionary mapping from each region to the keys of its locations.
+    self.regions = {}
+    for key, data in self.locations.items():
+      self.regions.setdefault(data.get("region", key), []).append(key)
+    # Dictionary mapping from the key of a location to the keys of the items
+    # that start there, in order.
+    self.start_items = {}
+    for key, data in self.items.items():
+      if data.get("start_at"):
+        self.start_items.setdefault(data["start_at"], []).append(key)
+
+  def location_data(self, key):
+    """Returns the dictionary describing a location, or None."""
+    return self.locations.get(key)
+
+  def item_data(self, key):
+    """Returns the dictionary describing an item, or None."""
+    return self.items.get(key)
+
+  def region_of(self, key):
+    return self.locations[key].get("region", key)
+
+  def region_locations(self, region):
+    return self.regions[region]
+
+  def all_regions(self):
+    return list(self.regions)
+
+  def items_starting_at(self, key):
+    return self.start_items.get(key, ())
+
+
+class WorldLoader:
+  """Builds the Locations and Items described by a world file as the game
+     needs them."""
+  def __init__(self, engine, world):
+    self.engine = load_engine(engine)
+    # Where the world is described: a WorldData, or anything with the same
+    # methods.  A dictionary is read as a world file.
+    self.source = WorldData(world) if isinstance(world, dict) else world
+    # Dictionaries mapping from keys to the Locations and Items built so far.
+    self.locations = {}
+    self.items = {}
+    # Dictionary mapping from each Location that has been built to its key.
+    self.keys = {}
+    # The regions that have been loaded.
+    self.loaded_regions = set()
+    # Dictionary mapping from the key of a location that hasn't been built to
+    # the locations that have connections to it.
+    self.waiting = {}
+    # The objects that have been built since the game's index was updated.
+    self.unindexed = []
+    # The Game, once it has been started.
+    self.game = None
+
+  def start_game(self):
+    """Build the start of the world and return a new Game."""
+    start = self.location(self.source.start)
+    game = self.engine.Game(start)
+    game.print_commands = self.source.print_commands
+    for key in self.source.inventory:
+      game.add_to_inventory(self.item(key))
+    self.game = game
+    game.loader = self
+    self.enter(start)
+    return game
+
+  def enter(self, location):
+    """Load the regions next to a location that the player has moved to."""
+    key = self.keys.get(location)
+    if key is not None:
+      for target_key in self.source.location_data(key).get("connections", {}).values():
+        self.location(target_key)
+    self.update_index()
+
+  def load_all(self):
+    """Load every region of the world."""
+    for region in self.source.all_regions():
+      self.load_region(region)
+    self.update_index()
+
+  def update_index(self):
+    """Give the objects that have been built since the last update ids in
+       the game."""
+    if self.game and self.unindexed:
+      things, self.unindexed = self.unindexed, []
+      self.game.index_world(*things)
+
+  def location(self, key):
+    """Returns the Location with the key, loading its region if needed."""
+    location = self.locations.get(key)
+    if location is None:
+      if self.source.location_data(key) is None:
+        raise ValueError("Unknown location: %s" % key)
+      self.load_region(self.source.region_of(key))
+      location = self.locations[key]
+    return location
+
+  def item(self, key):
+    """Returns the Item with the key, building it if needed.  An item is put
+       in the location it starts at when that location's region is loaded."""
+    item = self.items.get(key)
+    if item is None:
+      data = self.source.item_data(key)
+      if data is None:
+        raise ValueError("Unknown item: %s" % key)
+      item = self.engine.Item(data["name"], data["description"],
+                              examine_text=data.get("examine_text", ""),
+                              take_text=data.get("take_text", ""),
+                              gettable=data.get("gettable", True),
+                              end_game=data.get("end_game", False),
+                              aliases=data.get("aliases", ()))
+      self.items[key] = item
+      self.unindexed.append(item)
+      for action in data.get("actions", ()):
+        item.add_action(action["command"], self.function(action["function"]),
+                        self.resolve(action.get("arguments")),
+                        self.resolve(action.get("preconditions", {})))
+      if data.get("start_at") is not None:
+        self.location(data["start_at"])
+    return item
+
+  def function(self, name):
+    """Returns the special function of the game module with the name."""
+    function = getattr(self.engine, name, None)
+    if not callable(function):
+      raise ValueError("Unknown special function: %s" % name)
+    return function
+
+  def resolve(self, value):
+    """Replace the references in a value from the world file with the objects
+       that they name."""
+    if isinstance(value, dict):
+      if len(value) == 1:
+        (kind, name), = value.items()
+        if kind == "item":
+          return self.item(name)
+        if kind == "location":
+          return self.location(name)
+        if kind == "function":
+          return self.function(name)
+      return {key: self.resolve(entry) for key, entry in value.items()}
+    if isinstance(value, list):
+      return tuple(self.resolve(entry) for entry in value)
+    return value
+
+  def load_region(self, region):
+    """Build the locations of a region, with their connections to locations
+       that have already been built, their blocks, and their items."""
+    if region in self.loaded_regions:
+      return
+    self.loaded_regions.add(region)
+    keys = self.source.region_locations(region)
+    # Build every location in the region before anything that might refer to
+    # them.
+    for key in keys:
+      data = self.source.location_data(key)
+      location = self.engine.Location(data["name"], data["description"],
+                                      data.get("end_game", False))
+      self.locations[key] = location
+      self.keys[location] = key
+      self.unindexed.append(location)
+    for key in keys:
+      self.connect(self.locations[key])
+      for location in self.waiting.pop(key, ()):
+        self.connect(location)
+    for key in keys:
+      location = self.locations[key]
+      for direction, block in self.source.location_data(key).get("blocks", {}).items():
+        location.add_block(direction, block["description"],
+                           self.resolve(block.get("preconditions", {})))
+      for item_key in self.source.items_starting_at(key):
+        item = self.item(item_key)
+        location.add_item(item.name, item)
+
+  def connect(self, location):
+    """Set up the connections of a location to the locations that have been
+       built, in the order they are listed in the world file.  Connections to
+       locations that haven't been built are added when they are."""
+    data = self.source.location_data(self.keys[location])
+    travel_descriptions = data.get("travel_descriptions", {})
+    location.connections.clear()
+    location.version += 1
+    if location.game:
+      location.game.paths.clear()
+    for direction, target_key in data.get("connections", {}).items():
+      if travel_descriptions.get(direction):
+        location.travel_descriptions[direction] = travel_descriptions[direction]
+      target = self.locations.get(target_key)
+      if target:
+        location.connections[direction] = target
+      elif location not in self.waiting.setdefault(target_key, []):
+        self.waiting[target_key].append(location)
+
+
+def load_world(engine, world, lazy=True):
+  """Start a new game of the world in a world file, given as a path, an open
+     file, a dictionary or a WorldData.  If lazy is False the whole world is
+     built at once."""
+  if isinstance(world, str):
+    with open(world) as f:
+      world = json.load(f)
+  elif hasattr(world, "read"):
+    world = json.load(world)
+  loader = WorldLoader(engine, world)
+  game = loader.start_game()
+  if not lazy:
+    loader.load_all()
+  return game
+
+
+def dump_world(engine, game):
+  """Returns a world file, as a dictionary, that describes the world of a game
+     that has been built in Python.  The special functions of the actions must
+     be functions of the game module, so they can be found by name."""
+  engine = load_engine(engine)
+  game.index_world()
+  location_keys = make_keys(game.locations)
+  item_keys = make_keys(game.items)
+
+  def encode(value):
+    if isinstance(value, engine.Location):
+      return {"location": location_keys[value.id]}
+    if isinstance(value, engine.Item):
+      return {"item": item_keys[value.id]}
+    if isinstance(value, engine.Preconditions):
+      return encode(value.source)
+    if callable(value):
+      return {"function": value.__name__}
+    if isinstance(value, (tuple, list)):
+      return [encode(entry) for entry in value]
+    if isinstance(value, dict):
+      return {key: encode(entry) for key, entry in value.items()}
+    return value
+
+  locations = {}
+  for location in game.locations:
+    data = {"name": location.name, "description": location.description}
+    if location.end_game:
+      data["end_game"] = True
+    data["connections"] = {direction: location_keys[target.id]
+                           for direction, target in location.connections.items()}
+    travel_descriptions = {direction: text
+                           for direction, text in location.travel_descriptions.items() if text}
+    if travel_descriptions:
+      data["travel_descriptions"] = travel_descriptions
+    if location.blocks:
+      data["blocks"] = {direction: {"description": description, "preconditions": encode(preconditions)}
+                        for direction, (description, preconditions) in location.blocks.items()}
+    locations[location_keys[location.id]] = data
+
+  # Items are written in the order they are found in each location, so that
+  # they are listed in the same order when they are loaded.
+  ordered_items = [item for location in game.locations for item in location.items.values()]
+  ordered_items += [item for item in game.items if item not in ordered_items]
+  items = {}
+  for item in ordered_items:
+    data = {"name": item.name, "description": item.description}
+    if item.examine_text:
+      data["examine_text"] = item.examine_text
+    if item.take_text != "You take the %s." % item.name:
+      data["take_text"] = item.take_text
+    if item.aliases:
+      data["aliases"] = list(item.aliases)
+    if item.holder is not None and item.holder is not game:
+      data["start_at"] = location_keys[item.holder.id]
+    if not item.gettable:
+      data["gettable"] = False
+    if item.end_game:
+      data["end_game"] = True
+    actions = []
+    for command, (function, arguments, preconditions) in item.commands.items():
+      action = {"command": command, "function": function.__name__,
+                "arguments": encode(arguments)}
+      if preconditions.source:
+        action["preconditions"] = encode(preconditions)
+      actions.append(action)
+    if actions:
+      data["actions"] = actions
+    items[item_keys[item.id]] = data
+
+  return {
+    "start": location_keys[game.curr_location.id],
+    "inventory": [item_keys[item.id] for item in game.inventory.values()],
+    "print_commands": game.print_commands,
+    "locations": locations,
+    "items": items,
+  }
+
+
+def make_keys(things):
+  """Returns a list of unique keys made from the names of the things."""
+  keys = []
+  used = set()
+  for thing in things:
+    base = re.sub(r"[^a-z0-9]+", "_", thing.name.lower()).strip("_") or "thing"
+    key = base
+    number = 2
+    while key in used:
+      key = "%s_%d" % (base, number)
+      number += 1
+    used.add(key)
+    keys.append(key)
+  return keys
+
+
+def play(engine, world):
+  """Play the game in a world file on the console."""
+  engine = load_engine(engine)
+  game = load_world(engine, world)
+  parser = engine.Parser(game)
+  game.describe()
+  game.output.flush()
+  while True:
+    try:
+      command = input(">")
+    except EOFError:
+      break
+    if command.lower() in ("exit", "q"):
+      break
+    if parser.parse_command(command):
+      break
+  print('THE GAME HAS ENDED.')
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Write or play world files.")
+  commands = arg_parser.add_subparsers(dest="command", required=True)
+  dump_parser = commands.add_parser("dump", help="write the world of a game module as JSON")
+  dump_parser.add_argument("engine", help="game module, e.g. task1 or task2")
+  play_parser = commands.add_parser("play", help="play the game in a world file")
+  play_parser.add_argument("engine", help="game module with the engine and special functions")
+  play_parser.add_argument("world", help="world file to play")
+  args = arg_parser.parse_args(argv)
+
+  if args.command == "dump":
+    engine = load_engine(args.engine)
+    game = engine.build_game()
+    json.dump(dump_world(engine, game), sys.stdout, indent=2)
+    print()
+  else:
+    play(args.engine, args.world)
+
+
+if __name__ == "__main__":
+  main()
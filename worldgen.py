@@ -0,0 +1,359 @@
+"""Generate large worlds that can be won, for load testing and benchmarks.
+
+The two games that come with the engine only have a handful of locations,
+which is too few to see how the parser, the preconditions, the searches and
+saving and loading behave at scale.  This module builds worlds of any size
+with the engine's own `Location`, `Item`, `add_block` and `add_action`.
+The same options and seed always give the same world, so a generated world
+is a reproducible workload.
+
+A generated world has:
+
+* rooms joined into a tree, with extra connections that make loops.  The
+  room at the far end of the tree has a pedestal, and the player wins by
+  placing the treasure on it.
+* gates: blocked connections into rooms.  The key for a gate is always in a
+  room that comes before it, so every gate can be opened.  Half of the keys
+  open a gate by being carried, and the other half have to be used to
+  unlock a door by the gate, like the tower door in Action Castle.
+* chains of actions: an object that has to be taken to a series of rooms
+  and changed into something else in each of them.  The last object of the
+  first chain is the treasure.
+* other items, some of which can be taken, to fill the rooms.
+
+Along with the game, the generator works out a list of commands that wins
+it.  Run it from the command line to see the size of a world, to check that
+the winning commands work, or to write the world file and the commands out
+for other tools:
+
+```
+python3 worldgen.py --rooms 10000 --seed 7 --check
+python3 worldgen.py --rooms 1000 --world big.json --transcript big.txt
+```
+"""
+
+import argparse
+import itertools
+import json
+import random
+
+from replay import load_engine
+
+# Words that names and descriptions are made from.  None of them are words
+# that the parser treats as a verb or a direction.
+ROOM_ADJECTIVES = ["dusty", "echoing", "narrow", "vaulted", "damp", "sunlit",
+                   "crooked", "silent", "drafty", "painted", "mossy", "gilded"]
+ROOM_NOUNS = ["hall", "cellar", "gallery", "chapel", "library", "pantry",
+              "armory", "corridor", "study", "cloister", "vault", "kitchen"]
+KEY_MATERIALS = ["brass", "iron", "silver", "copper", "bone", "glass"]
+CHAIN_NOUNS = ["gem", "scroll", "idol", "lens", "rune", "feather", "shell",
+               "coin"]
+CHAIN_VERBS = ["polish", "attune", "enchant", "assemble", "unfold", "awaken"]
+TRINKET_NOUNS = ["pebble", "goblet", "candlestick", "tapestry", "statue",
+                 "vase", "bench", "mirror"]
+
+
+class Gate:
+  """A blocked connection into a room, and the key that opens it."""
+  def __init__(self, location, direction, room, key, key_room, door=None):
+    # The location that the blocked connection leads out of.
+    self.location = location
+    # The direction of the blocked connection.
+    self.direction = direction
+    # The location behind the gate.
+    self.room = room
+    # The Item that opens the gate, and the location where it starts.
+    self.key = key
+    self.key_room = key_room
+    # The door Item that the key creates by the gate, or None if carrying
+    # the key is enough.
+    self.door = door
+
+
+class GeneratedWorld:
+  """A generated game, together with the commands that win it."""
+  def __init__(self, game, seed):
+    self.game = game
+    # The seed that the world was generated from.
+    self.seed = seed
+    # The Locations of the world, in the order they were generated.
+    self.locations = []
+    # The Gates of the world, in the order they were generated.
+    self.gates = []
+    # A list of commands that wins the game.
+    self.solution = []
+
+  def play_solution(self, engine):
+    """Run the winning commands against the game, without printing anything.
+       Returns True if the player won.  This changes the game."""
+    engine = load_engine(engine)
+    game = self.game
+    output = game.output
+    game.output = engine.NullSink()
+    parser = engine.Parser(game)
+    try:
+      for command in self.solution:
+        if parser.parse_command(command):
+          break
+    finally:
+      game.output = output
+    return game.won
+
+
+class WorldGenerator:
+  """Builds a world out of the engine's objects from a seeded random number
+     generator."""
+  def __init__(self, engine, rooms=100, items=50, gates=10, chains=5,
+               chain_length=3, loops=None, seed=0):
+    self.engine = load_engine(engine)
+    if rooms < 2:
+      raise ValueError("A generated world needs at least 2 rooms")
+    self.rooms = rooms
+    self.items = items
+    # Gates can only be put on the connections into rooms after the first.
+    self.gate_count = min(gates, rooms - 1)
+    self.chains = max(chains, 1)
+    self.chain_length = max(chain_length, 1)
+    # The number of extra connections that make loops, by default one for
+    # every ten rooms.
+    self.loops = rooms // 10 if loops is None else loops
+    self.seed = seed
+    self.random = random.Random(seed)
+    # Numbers keep the names of items and rooms apart.  They are padded to
+    # the same width so that the names sort in the order they were made.
+    self.next_number = 0
+    count = 2 * self.gate_count + self.chains * self.chain_length + items
+    self.width = len(str(max(count, rooms)))
+
+  def generate(self):
+    """Returns a GeneratedWorld."""
+    self.locations = [self.make_location(number) for number in range(self.rooms)]
+    self.numbers = {location: number for number, location in enumerate(self.locations)}
+    self.parents = [None] * self.rooms
+    self.depths = [0] * self.rooms
+    self.connect_rooms()
+    world = GeneratedWorld(self.engine.Game(self.locations[0]), self.seed)
+    world.locations = self.locations
+    world.gates = self.add_gates()
+    chains = [self.add_chain() for _ in range(self.chains)]
+    goal = max(range(self.rooms), key=self.depths.__getitem__)
+    win_command = self.add_pedestal(self.locations[goal], chains[0][2])
+    self.add_trinkets()
+    world.solution = self.plan(world.gates, chains, self.locations[goal], win_command)
+    return world
+
+  def name(self, word):
+    """Returns a unique name for an item."""
+    self.next_number += 1
+    return "%s %0*d" % (word, self.width, self.next_number)
+
+  def make_location(self, number):
+    adjective = self.random.choice(ROOM_ADJECTIVES)
+    noun = self.random.choice(ROOM_NOUNS)
+    return self.engine.Location("%s %s %0*d" % (adjective.title(), noun.title(), self.width, number),
+                                "You are in a %s %s." % (adjective, noun))
+
+  def connect_rooms(self):
+    """Join each room to one that came before it, so that the rooms form a
+       tree rooted at the first one, then add connections between random
+       rooms to make loops.  All of the connections are made at once with
+       add_connections()."""
+    opposites = self.engine.DIRECTIONS.opposites
+    directions = sorted(opposites)
+    exits = [set() for _ in range(self.rooms)]
+    joined = set()
+    connections = []
+
+    def connect(a, b):
+      """Find a direction out of room a whose opposite is free in room b."""
+      for direction in self.random.sample(directions, len(directions)):
+        if direction not in exits[a] and opposites[direction] not in exits[b]:
+          exits[a].add(direction)
+          exits[b].add(opposites[direction])
+          joined.add((a, b))
+          joined.add((b, a))
+          connections.append((self.locations[a], direction, self.locations[b]))
+          return direction
+      return None
+
+    for number in range(1, self.rooms):
+      # Half of the rooms join one of the last few rooms, which makes long
+      # paths, and the others join any earlier room, which makes branches.
+      if self.random.random() < 0.5:
+        parent = self.random.randrange(max(0, number - 4), number)
+      else:
+        parent = self.random.randrange(number)
+      for candidate in itertools.chain([parent], range(number - 1, -1, -1)):
+        direction = connect(candidate, number)
+        if direction:
+          self.parents[number] = (candidate, direction)
+          self.depths[number] = self.depths[candidate] + 1
+          break
+    for _ in range(self.loops):
+      a, b = self.random.randrange(self.rooms), self.random.randrange(self.rooms)
+      if a != b and (a, b) not in joined:
+        connect(a, b)
+    self.engine.add_connections(connections)
+
+  def add_gates(self):
+    """Block the connections into some of the rooms.  The key for each gate
+       goes in an earlier room, which can always be reached without going
+       through the gate, since the rooms behind a gate all come after it."""
+    engine = self.engine
+    gates = []
+    for number in sorted(self.random.sample(range(1, self.rooms), self.gate_count)):
+      parent, direction = self.parents[number]
+      location = self.locations[parent]
+      key_room = self.locations[self.random.randrange(number)]
+      key = engine.Item(self.name(self.random.choice(KEY_MATERIALS) + " key"),
+                        "a key", "It looks like it fits a door somewhere.", start_at=key_room)
+      if len(gates) % 2:
+        door = engine.Item(self.name("door"), "an open door", "", gettable=False)
+        key.add_action("unlock " + door.name, engine.create_item,
+                       (door, "The door swings open."),
+                       preconditions={"in_location": location})
+        location.add_block(direction, "The door is locked.",
+                           preconditions={"location_has_item_silent": door})
+      else:
+        door = None
+        location.add_block(direction, "A gate that needs the %s blocks the way." % key.name,
+                           preconditions={"inventory_contains": key})
+      gates.append(Gate(location, direction, self.locations[number], key, key_room, door))
+    return gates
+
+  def add_chain(self):
+    """Add a chain of objects, each of which turns into the next one when
+       the player uses it in the right room.  Returns the room where the
+       first object starts, a list of (item, room, command) steps, and the
+       last object."""
+    engine = self.engine
+    noun = self.random.choice(CHAIN_NOUNS)
+    items = [engine.Item(self.name(noun), "a curious %s" % noun, "It might be useful somewhere.")
+             for _ in range(self.chain_length + 1)]
+    start_room = self.random.choice(self.locations)
+    start_room.add_item(items[0].name, items[0])
+    steps = []
+    for item, next_item in zip(items, items[1:]):
+      room = self.random.choice(self.locations)
+      command = "%s %s" % (self.random.choice(CHAIN_VERBS), item.name)
+      item.add_action(command, engine.perform_multiple_actions,
+        [(engine.destroy_item, (item, "The %s changes shape." % item.name)),
+         (engine.add_item_to_inventory, (next_item, "You now have the %s." % next_item.name,
+                                         "You already have the %s." % next_item.name))],
+        preconditions={"inventory_contains": item, "in_location": room})
+      steps.append((item, room, command))
+    return start_room, steps, items[-1]
+
+  def add_pedestal(self, room, treasure):
+    """Put the pedestal that wins the game in the room.  Returns the command
+       that wins."""
+    engine = self.engine
+    pedestal = engine.Item("pedestal", "a stone pedestal", "It has a hollow just the right size for the %s." % treasure.name,
+                           start_at=room, gettable=False)
+    command = "place %s on pedestal" % treasure.name
+    pedestal.add_action(command, engine.win_game,
+                        ("The %s glows on the pedestal. You have won!" % treasure.name),
+                        preconditions={"inventory_contains": treasure})
+    return command
+
+  def add_trinkets(self):
+    """Scatter other items around the world, half of which can be taken."""
+    engine = self.engine
+    for number in range(self.items):
+      noun = self.random.choice(TRINKET_NOUNS)
+      trinket = engine.Item(self.name(noun), "a %s" % noun, "It is an ordinary %s." % noun,
+                            start_at=self.random.choice(self.locations),
+                            gettable=number % 2 == 0)
+      if number % 4 == 1:
+        trinket.add_action("admire " + trinket.name, engine.describe_something,
+                           ("It is a fine %s." % noun))
+
+  def plan(self, gates, chains, goal, win_command):
+    """Returns a list of commands that wins the game: collect the keys and
+       open the gates in order, carry each chain through its rooms, and then
+       take the treasure to the pedestal.  The player only walks along the
+       tree of rooms, where the gates on the way to a key have always been
+       opened already, since they come before it."""
+    commands = []
+    here = self.locations[0]
+
+    def walk(destination):
+      commands.extend(self.path(here, destination))
+      return destination
+
+    for gate in gates:
+      here = walk(gate.key_room)
+      commands.append("take " + gate.key.name)
+      if gate.door:
+        here = walk(gate.location)
+        commands.append("unlock " + gate.door.name)
+    for start_room, steps, treasure in chains:
+      here = walk(start_room)
+      commands.append("take " + steps[0][0].name)
+      for item, room, command in steps:
+        here = walk(room)
+        commands.append(command)
+    walk(goal)
+    commands.append(win_command)
+    return commands
+
+  def path(self, start, destination):
+    """Returns the directions of the path between two rooms along the tree:
+       up from the start to the room they both branch from, and then down to
+       the destination."""
+    opposites = self.engine.DIRECTIONS.opposites
+    a, b = self.numbers[start], self.numbers[destination]
+    up, down = [], []
+    while a != b:
+      if self.depths[a] >= self.depths[b]:
+        a, direction = self.parents[a]
+        up.append(opposites[direction])
+      else:
+        b, direction = self.parents[b]
+        down.append(direction)
+    down.reverse()
+    return up + down
+
+
+def generate(engine, rooms=100, items=50, gates=10, chains=5, chain_length=3,
+             loops=None, seed=0):
+  """Generate a world for the engine module.  Returns a GeneratedWorld with
+     the game and the commands that win it."""
+  generator = WorldGenerator(engine, rooms, items, gates, chains, chain_length, loops, seed)
+  return generator.generate()
+
+
+def main(argv=None):
+  arg_parser = argparse.ArgumentParser(description="Generate a large world that can be won.")
+  arg_parser.add_argument("--engine", default="task1", help="game module to build the world with")
+  arg_parser.add_argument("--rooms", type=int, default=100, help="number of locations")
+  arg_parser.add_argument("--items", type=int, default=50, help="number of other items")
+  arg_parser.add_argument("--gates", type=int, default=10, help="number of blocked connections")
+  arg_parser.add_argument("--chains", type=int, default=5, help="number of chains of actions")
+  arg_parser.add_argument("--chain-length", type=int, default=3, help="actions in each chain")
+  arg_parser.add_argument("--loops", type=int, default=None, help="extra connections that make loops")
+  arg_parser.add_argument("--seed", type=int, default=0, help="random seed")
+  arg_parser.add_argument("--world", help="write the world file to this path")
+  arg_parser.add_argument("--transcript", help="write the winning commands to this path")
+  arg_parser.add_argument("--check", action="store_true", help="play the winning commands")
+  args = arg_parser.parse_args(argv)
+
+  engine = load_engine(args.engine)
+  world = generate(engine, args.rooms, args.items, args.gates, args.chains,
+                   args.chain_length, args.loops, args.seed)
+  world.game.index_world()
+  print("Generated %d locations and %d items; the game is won in %d commands." % (
+    len(world.game.locations), len(world.game.items), len(world.solution)))
+  if args.world:
+    from worldfile import dump_world
+    with open(args.world, "w") as f:
+      json.dump(dump_world(engine, world.game), f, indent=2)
+  if args.transcript:
+    with open(args.transcript, "w") as f:
+      f.write("\n".join(world.solution) + "\n")
+  if args.check:
+    print("Won." if world.play_solution(engine) else "The winning commands did not win.")
+
+
+if __name__ == "__main__":
+  main()